@@ -1,11 +1,41 @@
+# gevent must patch sockets/time before requests (urllib3) is imported
+from gevent import monkey
+monkey.patch_all()
 
 import os
+import re
+import hmac
 import json
+import random
+import gzip
+import hashlib
+import threading
 import time as pytime
+from urllib.parse import urlencode, quote_plus
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from itertools import islice
+from functools import lru_cache
+from types import MappingProxyType
 from typing import Tuple, Dict, Any, Optional
 
+try:
+    import orjson
+    _loads = orjson.loads
+    def _dumps(obj: Any) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:  # optional C-accelerated JSON; stdlib fallback
+    orjson = None
+    _loads = json.loads
+    def _dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
+# already-serialized JSON that _dumps embeds verbatim (orjson >= 3.9); None -> keep the parsed object
+_Fragment = getattr(orjson, "Fragment", None)
+
 import requests
-from flask import Flask, request, jsonify, session, render_template_string, Response
+from requests.adapters import HTTPAdapter
+from requests_toolbelt.multipart.encoder import MultipartEncoder
+from flask import Flask, request, session, Response, g, has_request_context, stream_with_context
 
 # ---- Page constants (info & update allowlist)
 PAGE_INFO_FIELDS = ",".join([
@@ -40,18 +70,44 @@ OPENAI_API_KEY = os.environ.get("OPENAI_API_KEY", "")
 OPENAI_MODEL = os.environ.get("OPENAI_MODEL", "gpt-4o-mini")
 
 ACCESS_PIN = os.environ.get("ACCESS_PIN", "").strip()
+_ACCESS_PIN_BYTES = ACCESS_PIN.encode("utf-8") if ACCESS_PIN else b""
+
+# Shared HTTP session: keep-alive pool reused across Graph / rupload calls
+SESSION = requests.Session()
+_adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32, max_retries=0)
+SESSION.mount("https://", _adapter)
+# (connect, read): fail fast on a dead connect, keep long reads for uploads
+CONNECT_TIMEOUT = 5
+
+# Hot-path rate-limit state lives in module globals (one LOAD_GLOBAL each);
+# SETTINGS["throttle"] aliases the same dict. SETTINGS["cooldown_until"] is gone:
+# the deadline is only in _COOLDOWN_UNTIL[0] (exposed as cooldown_remaining by /api/usage).
+_THROTTLE: Dict[str, float] = {
+    "global_min_interval": float(os.environ.get("GLOBAL_MIN_INTERVAL", "1.0")),
+    "per_page_min_interval": float(os.environ.get("PER_PAGE_MIN_INTERVAL", "2.0")),
+    "burst": float(os.environ.get("THROTTLE_BURST", "3"))}
+_COOLDOWN_UNTIL = [0]
+# read by /api/usage on every dashboard poll; updated in place, aliased by SETTINGS
+_LAST_USAGE: Dict[str, str] = {}
+_POLL_INTERVALS: Dict[str, int] = {"notif": 60, "conv": 120}
+# bumped on every webhook push; /webhook/events pollers revalidate against it
+_EVENT_SEQ = [0]
+# webhook bodies above this many bytes are not kept verbatim in the event trail
+WEBHOOK_AUDIT_MAX = 8192
 
 SETTINGS: Dict[str, Any] = {
     "app": {"app_id": os.environ.get("FB_APP_ID", ""), "app_secret": os.environ.get("FB_APP_SECRET", "")},
     "webhook_verify_token": os.environ.get("WEBHOOK_VERIFY_TOKEN", "verify-token"),
-    "cooldown_until": 0,
-    "last_usage": {},
-    "poll_intervals": {"notif": 60, "conv": 120},
-    "_last_events": [],
-    "throttle": {"global_min_interval": float(os.environ.get("GLOBAL_MIN_INTERVAL", "1.0")),
-                 "per_page_min_interval": float(os.environ.get("PER_PAGE_MIN_INTERVAL", "2.0"))},
-    "last_call_ts": {},
-    "_recent_posts": []}
+    "last_usage": _LAST_USAGE,
+    "poll_intervals": _POLL_INTERVALS,
+    "_last_events": deque(maxlen=100),
+    "throttle": _THROTTLE,
+    "_recent_posts": {}}
+_VERIFY_TOKEN_BYTES = (SETTINGS["webhook_verify_token"] or "").encode("utf-8")
+# webhook deliveries are signed with the app secret; unset -> signatures are not checked
+_APP_SECRET_BYTES = (SETTINGS["app"]["app_secret"] or "").encode("utf-8")
+# the same token as it appears, form-encoded, in a raw query string
+_VERIFY_TOKEN_QS = quote_plus(SETTINGS["webhook_verify_token"] or "").encode("ascii")
 
 # ----------------------------
 # Simple PIN gate for /api/* (except webhook & pin endpoints)
@@ -68,143 +124,289 @@ def _require_pin_for_api():
         return
     # Always allow diagnostics minimal so user can see gating? No—protect it.
     if not session.get("pin_ok", False):
-        return jsonify({"error": "PIN_REQUIRED"}), 401
+        return json_response({"error": "PIN_REQUIRED"}), 401
 
 @app.route("/api/pin/status")
 def api_pin_status():
-    return jsonify({"ok": bool(session.get("pin_ok", False)), "need_pin": bool(ACCESS_PIN)}), 200
+    return json_response({"ok": bool(session.get("pin_ok", False)), "need_pin": bool(ACCESS_PIN)}), 200
+
+def json_response(obj: Any, passthrough: bool = False) -> Response:
+    # drop-in for flask.jsonify, serialized with _dumps;
+    # passthrough hands the bytes to the WSGI server as-is (for the hot polling endpoints)
+    return Response(_dumps(obj), mimetype="application/json", direct_passthrough=passthrough)
+
+def _json_body() -> Optional[Dict[str, Any]]:
+    # parse the raw body directly (skips get_json's decode/validation chain)
+    try:
+        body = _loads(request.get_data(cache=False) or b"{}")
+    except Exception:
+        return None
+    return body if isinstance(body, dict) else None
 
 @app.route("/api/pin/login", methods=["POST"])
 def api_pin_login():
-    body = request.get_json(force=True)
+    body = _json_body()
+    if body is None: return json_response({"error": "BAD_JSON"}), 400
     pin = (body.get("pin") or "").strip()
     if not ACCESS_PIN:
         session["pin_ok"] = True
-        return jsonify({"ok": True, "note": "PIN not set on server"}), 200
-    if pin and pin == ACCESS_PIN:
+        return json_response({"ok": True, "note": "PIN not set on server"}), 200
+    if pin and hmac.compare_digest(pin.encode("utf-8"), _ACCESS_PIN_BYTES):
         session["pin_ok"] = True
-        return jsonify({"ok": True}), 200
-    return jsonify({"error": "INVALID_PIN"}), 403
+        return json_response({"ok": True}), 200
+    return json_response({"error": "INVALID_PIN"}), 403
 
 @app.route("/api/pin/logout", methods=["POST"])
 def api_pin_logout():
     session.pop("pin_ok", None)
-    return jsonify({"ok": True}), 200
+    return json_response({"ok": True}), 200
 
 # ----------------------------
 # Helpers: tokens
 # ----------------------------
+_TOKENS_CACHE: Dict[str, Any] = {"mtime": 0, "data": {}}
+
 def load_tokens() -> Dict[str, Any]:
-    if not os.path.exists(TOKENS_FILE):
-        return {}
-    with open(TOKENS_FILE, "r", encoding="utf-8") as f:
-        return json.load(f)
+    # parsed file is memoized until tokens.json changes on disk
+    st = os.stat(TOKENS_FILE).st_mtime_ns if os.path.exists(TOKENS_FILE) else 0
+    if st == _TOKENS_CACHE["mtime"]:
+        return _TOKENS_CACHE["data"]
+    data: Dict[str, Any] = {}
+    if st:
+        with open(TOKENS_FILE, "rb") as f:
+            data = _loads(f.read())
+    _TOKENS_CACHE.update(mtime=st, data=data)
+    return data
 
 def save_tokens(data: dict):
     import os as _os
     _os.makedirs(_os.path.dirname(TOKENS_FILE) or ".", exist_ok=True)
-    with open(TOKENS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
+    if orjson is not None:
+        with open(TOKENS_FILE, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(TOKENS_FILE, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+    # write-through: the dict just written is the new cached copy
+    _TOKENS_CACHE.update(mtime=os.stat(TOKENS_FILE).st_mtime_ns, data=data)
 
 def app_cfg() -> Tuple[Optional[str], Optional[str]]:
     a = SETTINGS.get("app", {}) or {}
     return a.get("app_id"), a.get("app_secret")
 
+def _user_token() -> Optional[str]:
+    # resolved on first use and memoized on g for the rest of the request
+    if "user_token" not in g:
+        g.user_token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    return g.user_token
+
 # ----------------------------
 # Helpers: throttle and guard
 # ----------------------------
+class TokenBucket:
+    # allows `cap` calls back-to-back, then one call per `interval` seconds
+    __slots__ = ("tokens", "cap", "rate", "base", "ts")
+
+    def __init__(self, interval: float, cap: float):
+        self.cap = max(1.0, cap)
+        self.tokens = self.cap
+        self.rate = self.base = 1.0 / interval if interval > 0 else 0.0
+        self.ts = pytime.monotonic()
+
+    def adapt(self, usage: int):
+        # full refill rate below 50% of Graph quota, tapering to 20% at 90%
+        factor = 1.0 if usage < 50 else max(0.1, 1.0 - (usage - 50) / 50.0)
+        self.rate = self.base * factor
+
+    def consume(self) -> float:
+        # take one token (may go negative = reserved); return seconds to wait
+        if not self.rate:
+            return 0.0
+        now = pytime.monotonic()
+        self.tokens = min(self.cap, self.tokens + (now - self.ts) * self.rate) - 1.0
+        self.ts = now
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+_BUCKETS: Dict[str, TokenBucket] = {}
+
+def _bucket(key: str) -> TokenBucket:
+    b = _BUCKETS.get(key)
+    if b is None:
+        interval = _THROTTLE["per_page_min_interval"] if key.startswith("page:") else _THROTTLE["global_min_interval"]
+        b = _BUCKETS[key] = TokenBucket(interval, _THROTTLE["burst"])
+    return b
+
 def _wait_throttle(key: str):
-    now = pytime.time()
-    last_ts = SETTINGS["last_call_ts"].get(key, 0.0)
-    if key.startswith("page:"):
-        gap = SETTINGS["throttle"]["per_page_min_interval"]
-    else:
-        gap = SETTINGS["throttle"]["global_min_interval"]
-    g_last = SETTINGS["last_call_ts"].get("global", 0.0)
-    g_gap = SETTINGS["throttle"]["global_min_interval"]
-    sleep_for = max(0.0, last_ts + gap - now, g_last + g_gap - now)
-    if sleep_for > 0:
-        pytime.sleep(sleep_for)
-    SETTINGS["last_call_ts"][key] = pytime.time()
-    SETTINGS["last_call_ts"]["global"] = pytime.time()
-
-def _hash_content(s: str) -> str:
-    import hashlib
-    return hashlib.sha256((s or "").strip().encode("utf-8")).hexdigest()
+    # every call spends a global token; page keys also spend their own
+    wait = _bucket("global").consume()
+    if key != "global":
+        wait = max(wait, _bucket(key).consume())
+    if wait > 0:
+        pytime.sleep(wait)
+
+_RECENT_GUARD_MAX = 1024
+
+def _hash_content(s: str) -> bytes:
+    # equality-only dedup key: 128-bit BLAKE2b is plenty for a 1h window
+    return hashlib.blake2b((s or "").strip().encode("utf-8"), digest_size=16).digest()
 
 def _recent_content_guard(kind: str, key: str, content: str, within_sec: int = 3600) -> bool:
+    return _recent_hash_guard(kind, key, _hash_content(content), within_sec)
+
+def _recent_hash_guard(kind: str, key: str, h: bytes, within_sec: int = 3600) -> bool:
+    # same as _recent_content_guard, for callers that hash once and check many pages
     now = int(pytime.time())
-    h = _hash_content(content)
-    SETTINGS["_recent_posts"] = [x for x in SETTINGS["_recent_posts"] if now - x["ts"] <= within_sec]
-    for x in SETTINGS["_recent_posts"]:
-        if x["type"] == kind and x["key"] == key and x["content_hash"] == h:
-            return True
-    SETTINGS["_recent_posts"].append({"ts": now, "type": kind, "key": key, "content_hash": h})
+    # (kind, key) -> (deque of (ts, hash) oldest first, set of hashes in the window)
+    dq, seen = SETTINGS["_recent_posts"].setdefault((kind, key), (deque(), set()))
+    while dq and now - dq[0][0] > within_sec:
+        seen.discard(dq.popleft()[1])
+    if h in seen:
+        return True
+    dq.append((now, h))
+    seen.add(h)
+    # bound a busy page's window; hashes are unique in dq, so the set stays in step
+    if len(dq) > _RECENT_GUARD_MAX:
+        seen.discard(dq.popleft()[1])
     return False
 
+def _recent_hash_forget(kind: str, key: str, h: bytes):
+    # undo a _recent_hash_guard record when the publish it guarded failed
+    entry = SETTINGS["_recent_posts"].get((kind, key))
+    if not entry or h not in entry[1]:
+        return
+    dq, seen = entry
+    seen.discard(h)
+    for item in dq:
+        if item[1] == h:
+            dq.remove(item)
+            break
+
 # ----------------------------
 # Helpers: Graph API + Rate-limit
 # ----------------------------
-def _update_usage_and_cooldown(r: requests.Response):
+def _usage_top(raw: Optional[str]) -> int:
+    # highest usage % in an x-app-usage / x-page-usage / x-business-use-case-usage value
+    if not raw:
+        return 0
     try:
-        hdr = r.headers or {}
-        usage = hdr.get("x-app-usage") or hdr.get("X-App-Usage") or ""
-        pusage = hdr.get("x-page-usage") or hdr.get("X-Page-Usage") or ""
-        SETTINGS["last_usage"] = {"app": usage, "page": pusage}
-        for key in ["x-app-usage", "X-App-Usage", "x-page-usage", "X-Page-Usage"]:
-            if key in hdr:
-                try:
-                    u = hdr[key]
-                    if isinstance(u, str):
-                        u = json.loads(u)
-                    top = max(int(u.get("call_count", 0)), int(u.get("total_time", 0)), int(u.get("total_cputime", 0)))
-                    now = int(pytime.time())
-                    if top >= 90: SETTINGS["cooldown_until"] = max(SETTINGS.get("cooldown_until", 0), now + 300)
-                    elif top >= 80: SETTINGS["cooldown_until"] = max(SETTINGS.get("cooldown_until", 0), now + 120)
-                except Exception:
-                    pass
+        u = _loads(raw)
+        # business use case usage: {"<biz_id>": [{"call_count": ..}, ..]}
+        rows = [x for v in u.values() if isinstance(v, list) for x in v] if "call_count" not in u else [u]
+        return max((max(int(x.get("call_count", 0)), int(x.get("total_time", 0)), int(x.get("total_cputime", 0)))
+                    for x in rows if isinstance(x, dict)), default=0)
+    except Exception:
+        return 0
+
+# last seen (app, page, business) usage headers and the usage % parsed from them
+_USAGE_SEEN: Dict[str, Any] = {"raw": None, "app": 0, "page": 0}
+# bumped whenever _LAST_USAGE changes; part of the /api/usage ETag
+_USAGE_REV = [0]
+
+def _update_usage_and_cooldown(r: requests.Response, ctx_key: Optional[str] = None):
+    try:
+        # requests headers are case-insensitive: one lookup per header
+        usage = r.headers.get("x-app-usage")
+        pusage = r.headers.get("x-page-usage")
+        busage = r.headers.get("x-business-use-case-usage")
+        raw = (usage, pusage, busage)
+        if raw != _USAGE_SEEN["raw"]:
+            # only parse when the header strings changed since the last response
+            _LAST_USAGE.update(app=usage or "", page=pusage or "")
+            _USAGE_REV[0] += 1
+            _USAGE_SEEN.update(raw=raw, app=_usage_top(usage), page=max(_usage_top(pusage), _usage_top(busage)))
+        app_top, page_top = _USAGE_SEEN["app"], _USAGE_SEEN["page"]
+        # pace the buckets by how close Graph says we are to the limit
+        _bucket("global").adapt(app_top)
+        if ctx_key:
+            _bucket(ctx_key).adapt(page_top)
+        top = max(app_top, page_top)
+        if top >= 80:
+            now = int(pytime.time())
+            _extend_cooldown(now + (300 if top >= 90 else 120))
     except Exception:
         pass
 
+def _extend_cooldown(until: int):
+    # stored as an int once, so readers only compare and subtract
+    if until > _COOLDOWN_UNTIL[0]:
+        _COOLDOWN_UNTIL[0] = int(until)
+
 def _respect_cooldown() -> int:
     now = int(pytime.time())
-    cu = int(SETTINGS.get("cooldown_until", 0) or 0)
+    cu = _COOLDOWN_UNTIL[0]
     if now < cu:
         return cu - now
     return 0
 
+MAX_ATTEMPTS = 5
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 30.0
+
 def _handle_429_and_maybe_retry(r: requests.Response, attempt: int):
     try:
         ra = int(r.headers.get("Retry-After", "0") or "0")
     except Exception:
-        ra = 300
-    SETTINGS["cooldown_until"] = max(SETTINGS.get("cooldown_until", 0), int(pytime.time()) + max(ra, 120))
-    if attempt == 0 and ra <= 5:
-        pytime.sleep(ra or 1)
-        return None, -1
-    return {"error": "RATE_LIMIT", "retry_after": ra}, 429
+        ra = 0
+    # give up (and cool down) only after the last attempt or an oversized Retry-After
+    if attempt + 1 >= MAX_ATTEMPTS or ra > BACKOFF_CAP:
+        _extend_cooldown(int(pytime.time()) + max(ra, 120))
+        return {"error": "RATE_LIMIT", "retry_after": ra}, 429
+    delay = ra if ra > 0 else min(BACKOFF_CAP, BACKOFF_BASE * (2 ** attempt)) * random.uniform(0.5, 1.5)
+    pytime.sleep(delay)
+    return None, -1
+
+@lru_cache(maxsize=256)
+def _auth_headers(token: Optional[str]) -> Dict[str, str]:
+    # shared per token; requests copies headers before sending, never mutate
+    return {"Authorization": f"Bearer {token}"} if token else {}
+
+def _ttl_cache_get(cache: "OrderedDict", key) -> Any:
+    hit = cache.get(key)
+    if hit and hit[0] > pytime.time():
+        cache.move_to_end(key)
+        return hit[1]
+    return None
+
+def _ttl_cache_put(cache: "OrderedDict", key, value: Any, ttl: float, cap: int):
+    cache[key] = (pytime.time() + ttl, value)
+    cache.move_to_end(key)
+    while len(cache) > cap:
+        cache.popitem(last=False)
+
+_GET_CACHE: "OrderedDict[tuple, Tuple[float, Any]]" = OrderedDict()
+_GET_CACHE_MAX = 1024
 
 def graph_get(path: str, params: Dict[str, Any], token: Optional[str], ttl: int = 0, ctx_key: Optional[str] = None):
+    key = None
+    if ttl > 0:
+        key = (path, tuple(sorted((params or {}).items())), token)
+        hit = _ttl_cache_get(_GET_CACHE, key)
+        if hit is not None:
+            return hit, 200
     rem = _respect_cooldown()
     if rem > 0:
         return {"error": "RATE_LIMIT", "retry_after": rem}, 429
     url = f"{GRAPH_BASE}/{path}"
-    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    headers = _auth_headers(token)
     attempts = 0
     while True:
         try:
-            _wait_throttle("global")
-            if ctx_key: _wait_throttle(ctx_key)
-            r = requests.get(url, params=params, headers=headers, timeout=60)
-            _update_usage_and_cooldown(r)
+            _wait_throttle(ctx_key or "global")
+            r = SESSION.get(url, params=params, headers=headers, timeout=(CONNECT_TIMEOUT, 60))
+            _update_usage_and_cooldown(r, ctx_key)
             if r.status_code == 429:
                 data, st = _handle_429_and_maybe_retry(r, attempts)
                 if st == -1: attempts += 1; continue
                 return data, st
             if r.status_code >= 400:
-                try: return r.json(), r.status_code
-                except Exception: return {"error": r.text}, r.status_code
-            return r.json(), 200
+                try: err = r.json()
+                except Exception: err = {"error": r.text}
+                if _token_rejected(r.status_code, err): _forget_page_token(token)
+                return err, r.status_code
+            data = r.json()
+            if key is not None:
+                _ttl_cache_put(_GET_CACHE, key, data, ttl, _GET_CACHE_MAX)
+            return data, 200
         except requests.RequestException as e:
             return {"error": str(e)}, 500
 
@@ -213,21 +415,22 @@ def graph_post(path: str, data: Dict[str, Any], token: Optional[str], ctx_key: O
     if rem > 0:
         return {"error": "RATE_LIMIT", "retry_after": rem}, 429
     url = f"{GRAPH_BASE}/{path}"
-    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    headers = _auth_headers(token)
     attempts = 0
     while True:
         try:
-            _wait_throttle("global")
-            if ctx_key: _wait_throttle(ctx_key)
-            r = requests.post(url, data=data, headers=headers, timeout=120)
-            _update_usage_and_cooldown(r)
+            _wait_throttle(ctx_key or "global")
+            r = SESSION.post(url, data=data, headers=headers, timeout=(CONNECT_TIMEOUT, 120))
+            _update_usage_and_cooldown(r, ctx_key)
             if r.status_code == 429:
                 data2, st = _handle_429_and_maybe_retry(r, attempts)
                 if st == -1: attempts += 1; continue
                 return data2, st
             if r.status_code >= 400:
-                try: return r.json(), r.status_code
-                except Exception: return {"error": r.text}, r.status_code
+                try: err = r.json()
+                except Exception: err = {"error": r.text}
+                if _token_rejected(r.status_code, err): _forget_page_token(token)
+                return err, r.status_code
             return r.json(), 200
         except requests.RequestException as e:
             return {"error": str(e)}, 500
@@ -237,29 +440,53 @@ def graph_post_multipart(path: str, files: Dict[str, Any], form: Dict[str, Any],
     if rem > 0:
         return {"error": "RATE_LIMIT", "retry_after": rem}, 429
     url = f"{GRAPH_BASE}/{path}"
-    headers = {"Authorization": f"Bearer {token}"} if token else {}
+    headers = _auth_headers(token)
     attempts = 0
     while True:
         try:
-            _wait_throttle("global")
-            if ctx_key: _wait_throttle(ctx_key)
-            r = requests.post(url, files=files, data=form, headers=headers, timeout=300)
-            _update_usage_and_cooldown(r)
+            _wait_throttle(ctx_key or "global")
+            # stream the body in chunks instead of buffering the whole file;
+            # rewind first so a 429 retry re-sends the full file
+            fields = dict(form)
+            for k, (fname, fp, ctype) in files.items():
+                if hasattr(fp, "seek"): fp.seek(0)
+                fields[k] = (fname, fp, ctype)
+            enc = MultipartEncoder(fields=fields)
+            r = SESSION.post(url, data=enc, headers={**headers, "Content-Type": enc.content_type}, timeout=(CONNECT_TIMEOUT, 600))
+            _update_usage_and_cooldown(r, ctx_key)
             if r.status_code == 429:
                 data2, st = _handle_429_and_maybe_retry(r, attempts)
                 if st == -1: attempts += 1; continue
                 return data2, st
             if r.status_code >= 400:
-                try: return r.json(), r.status_code
-                except Exception: return {"error": r.text}, r.status_code
+                try: err = r.json()
+                except Exception: err = {"error": r.text}
+                if _token_rejected(r.status_code, err): _forget_page_token(token)
+                return err, r.status_code
             return r.json(), 200
         except requests.RequestException as e:
             return {"error": str(e)}, 500
 
+def _batch_item(item: Optional[Dict[str, Any]]) -> Tuple[Any, int]:
+    # one entry of a Graph batch response: (decoded body, HTTP code)
+    item = item or {}
+    try:
+        return _loads(item.get("body") or "{}"), item.get("code") or 500
+    except Exception:
+        return {"error": item.get("body")}, item.get("code") or 500
+
 
 # ------- ENV-based page tokens (no app id/secret needed) -------
+_ENV_SPLIT = re.compile(r"[\n,]+")
+_ENV_KV = re.compile(r"^\s*([^|:=\s]+)\s*[|:=]\s*(.+?)\s*$")
+
+@lru_cache(maxsize=1)
 def _env_get_tokens():
-    raw = os.environ.get("PAGE_TOKENS", "") or ""
+    # env is fixed for the process lifetime: parse once, hand out read-only views
+    mapping, loose_tokens = _env_parse_tokens(os.environ.get("PAGE_TOKENS", "") or "")
+    return MappingProxyType(mapping), tuple(loose_tokens)
+
+def _env_parse_tokens(raw: str):
     mapping, loose_tokens = {}, []
     raw = raw.strip()
     if not raw:
@@ -273,15 +500,13 @@ def _env_get_tokens():
             return mapping, loose_tokens
     except Exception:
         pass
-    parts = [x.strip() for x in re.split(r"[\n,]+", raw) if x.strip()]
-    for x in parts:
-        if "|" in x or ":" in x or "=" in x:
-            for sep in ("|",":","="):
-                if sep in x:
-                    pid, tok = x.split(sep,1)
-                    pid, tok = pid.strip(), tok.strip()
-                    if pid and tok: mapping[pid]=tok
-                    break
+    for x in _ENV_SPLIT.split(raw):
+        x = x.strip()
+        if not x:
+            continue
+        m = _ENV_KV.match(x)
+        if m:
+            mapping[m.group(1)] = m.group(2)
         else:
             loose_tokens.append(x)
     return mapping, loose_tokens
@@ -289,24 +514,34 @@ def _env_get_tokens():
 def _env_resolve_loose_tokens(existing: dict):
     pages = []
     _, loose = _env_get_tokens()
-    for tok in loose:
-        d, st = graph_get("me", {"fields":"id,name"}, tok, ttl=0)
+    if not loose:
+        return pages
+    # fan out the /me lookups; each token is independent
+    with ThreadPoolExecutor(max_workers=min(8, len(loose))) as ex:
+        results = list(ex.map(lambda t: graph_get("me", {"fields":"id,name"}, t, ttl=300), loose))
+    for tok, (d, st) in zip(loose, results):
         if st==200 and isinstance(d, dict) and d.get("id"):
             pid=str(d["id"]); existing.setdefault(pid, tok)
             pages.append({"id": pid, "name": d.get("name",""), "access_token": tok})
     return pages
 
+def _env_page_name(pid: str, tok: str) -> str:
+    try:
+        d, st = graph_get(str(pid), {"fields":"name"}, tok, ttl=300, ctx_key=_ctx_key_for_page(pid))
+        if st==200 and isinstance(d, dict): return d.get("name","")
+    except Exception: pass
+    return ""
+
 def _env_pages_list():
     mp, _ = _env_get_tokens()
     pages=[]
-    for pid, tok in mp.items():
-        name=""
-        try:
-            d, st = graph_get(str(pid), {"fields":"name"}, tok, ttl=0)
-            if st==200 and isinstance(d, dict): name=d.get("name","")
-        except Exception: pass
-        pages.append({"id": str(pid), "name": name or str(pid), "access_token": tok})
-    pages.extend(_env_resolve_loose_tokens(mp))
+    if mp:
+        # names fetched concurrently; per-page buckets still pace each page
+        with ThreadPoolExecutor(max_workers=min(8, len(mp))) as ex:
+            names = list(ex.map(_env_page_name, mp.keys(), mp.values()))
+        for (pid, tok), name in zip(mp.items(), names):
+            pages.append({"id": str(pid), "name": name or str(pid), "access_token": tok})
+    pages.extend(_env_resolve_loose_tokens(dict(mp)))
     return pages
 def get_page_access_token(page_id: str, user_token: str) -> Optional[str]:
     # ENV first
@@ -328,812 +563,145 @@ def get_page_access_token(page_id: str, user_token: str) -> Optional[str]:
         return found.get(page_id)
     return None
 
+_PAGE_TOKEN_CACHE: "OrderedDict[Tuple[str, bytes], Tuple[float, str]]" = OrderedDict()
+_PAGE_TOKEN_CACHE_MAX = 512
+_PAGE_TOKEN_LOCK = threading.Lock()
+
+def _cached_page_token(page_id: str, user_token: str, ttl: int = 600) -> Optional[str]:
+    # (page_id, hash(user_token)) -> page token, so handlers skip the lookup for `ttl` s
+    key = (str(page_id), hashlib.blake2b((user_token or "").encode("utf-8"), digest_size=16).digest())
+    now = pytime.time()
+    with _PAGE_TOKEN_LOCK:
+        hit = _PAGE_TOKEN_CACHE.get(key)
+        if hit and hit[0] > now:
+            _PAGE_TOKEN_CACHE.move_to_end(key)
+            return hit[1]
+    tok = get_page_access_token(page_id, user_token)
+    if tok:
+        with _PAGE_TOKEN_LOCK:
+            _PAGE_TOKEN_CACHE[key] = (now + ttl, tok)
+            _PAGE_TOKEN_CACHE.move_to_end(key)
+            if len(_PAGE_TOKEN_CACHE) > _PAGE_TOKEN_CACHE_MAX:
+                _PAGE_TOKEN_CACHE.popitem(last=False)
+    return tok
+
+def _token_rejected(status: int, err: Any) -> bool:
+    # expired/revoked tokens: a bare 401, or OAuthException code 190 (usually sent as a 400);
+    # a 403 is a permission error on a still-valid token and keeps the token cached
+    if status == 401:
+        return True
+    e = err.get("error") if isinstance(err, dict) else None
+    return isinstance(e, dict) and e.get("code") == 190
+
+def _forget_page_token(token: Optional[str]):
+    # called when Graph rejects a token as expired/revoked: drop it from the LRU and
+    # from tokens.json, so the next lookup asks me/accounts for a fresh page token
+    if not token:
+        return
+    if has_request_context() and token == g.get("user_token"):
+        return  # the user token is never a cached page token
+    with _PAGE_TOKEN_LOCK:
+        for k in [k for k, (_, v) in _PAGE_TOKEN_CACHE.items() if v == token]:
+            del _PAGE_TOKEN_CACHE[k]
+    try:
+        store = load_tokens()
+        pages = store.get("pages") or {}
+        stale = [pid for pid, v in pages.items() if v == token]
+        if stale:
+            store["pages"] = {pid: v for pid, v in pages.items() if v != token}
+            save_tokens(store)
+    except Exception:
+        pass
+
 def _ctx_key_for_page(page_id: str) -> str:
     return f"page:{page_id}"
 
 # ----------------------------
-# UI
+# UI (static/index.html, loaded and gzipped once at import; no Jinja)
 # ----------------------------
-INDEX_HTML = r"""<!DOCTYPE html>
-<html lang="vi">
-<head>
-  <meta charset="utf-8"/>
-  <meta name="viewport" content="width=device-width,initial-scale=1"/>
-  <title>Thang 5 chi (Completed)</title>
-  <style>
-
-    :root{
-      --bg:#f6f7f9;
-      --card-bg:#ffffff;
-      --text:#222;
-      --muted:#6b7280;
-      --border:#e6e8eb;
-      --primary:#1976d2;
-      --radius:12px;
-      --shadow:0 6px 18px rgba(10,10,10,.06);
-    }
-    *{box-sizing:border-box}
-    html,body{height:100%}
-    body{
-      font-family:system-ui,Segoe UI,Arial,sans-serif;
-      margin:0;
-      background:var(--bg);
-      color:var(--text);
-    }
-    .container{
-      max-width:1100px;
-      margin:18px auto;
-      padding:0 16px;
-    }
-    h1{margin:0 0 12px;font-size:22px}
-    h3{margin:0 0 8px;font-size:16px}
-    .tabs{
-      position:sticky; top:0; z-index:10;
-      display:flex; gap:8px; padding:8px 0; background:var(--bg);
-      border-bottom:1px solid var(--border);
-    }
-    .tabs button{
-      padding:8px 12px; border:1px solid var(--border);
-      border-radius:999px; background:#fff; cursor:pointer;
-      font-size:13px; line-height:1;
-    }
-    .tabs button.active{background:var(--primary);color:#fff;border-color:var(--primary)}
-    .panel{display:none}
-    .panel.active{display:block}
-    .row{display:flex;gap:12px;flex-wrap:wrap}
-    .col{flex:1 1 420px;min-width:320px}
-    textarea,input,select{
-      width:100%; padding:9px 10px; border:1px solid var(--border);
-      border-radius:10px; background:var(--card-bg);
-      font-size:14px; outline:none;
-    }
-    textarea{resize:vertical}
-    input[type="file"]{padding:6px}
-    .card{
-      border:1px solid var(--border);
-      background:var(--card-bg);
-      border-radius:var(--radius);
-      padding:12px;
-      box-shadow:var(--shadow);
-    }
-    .list{
-      padding:4px; max-height:320px; overflow:auto; background:#fafafa;
-      border-radius:10px; border:1px dashed var(--border);
-      overscroll-behavior:contain;
-    }
-    /* chat bubbles */
-    .msg{display:flex;margin:6px 0}
-    .msg.me{justify-content:flex-end}
-    .bubble{max-width:78%;padding:9px 11px;border-radius:16px;line-height:1.4;word-break:break-word;white-space:pre-wrap}
-    .me .bubble{background:#e7f3ff;border:1px solid #cfe7ff}
-    .other .bubble{background:#f5f5f5;border:1px solid #ebebeb}
-    .meta{font-size:12px;color:#666;margin-top:4px}
-    .conv-item{padding:8px 10px;display:flex;align-items:center;gap:8px}
-    .conv-item + .conv-item{border-top:1px dashed var(--border)}
-    .conv-title{flex:1 1 auto;overflow:hidden;text-overflow:ellipsis;white-space:nowrap}
-    .dot{min-width:10px;width:10px;height:10px;border-radius:50%}
-    .dot.red{background:#e53935}
-    .dot.green{background:#43a047}
-    .status{margin-top:6px;font-size:12px;color:var(--muted);word-break:break-word}
-    .item{padding:6px 8px;border-bottom:1px dashed var(--border); background:transparent}
-    .item:last-child{border-bottom:none}
-    .muted{color:var(--muted)}
-    .btn{
-      padding:8px 12px;border:1px solid var(--border);border-radius:10px;background:#fff;cursor:pointer;
-      font-size:13px;
-    }
-    .btn.primary{background:var(--primary);color:#fff;border-color:var(--primary)}
-    .grid{display:grid;gap:8px;grid-template-columns:repeat(2,minmax(220px,1fr))}
-    .toolbar{display:flex;gap:8px;flex-wrap:wrap}
-    a{color:var(--primary);text-decoration:none}
-    a:hover{text-decoration:underline}
-    .pin-overlay{position:fixed;inset:0;background:rgba(250,250,252,.96);display:none;align-items:center;justify-content:center;z-index:9999}
-    .pin-box{border:1px solid var(--border);border-radius:16px;padding:18px;min-width:300px;background:#fff;box-shadow:var(--shadow)}
-    @media (max-width: 768px){
-      .col{min-width:100%}
-      .grid{grid-template-columns:1fr}
-      .list{max-height:260px}
-      h1{font-size:18px}
-    }
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-
-/* ===== Fanpage list: 1 dòng, checkbox sát mép phải ===== */
-.list .item {
-  display: flex;
-  align-items: center;
-  justify-content: space-between;
-  padding: 6px 10px;
-  border-bottom: 1px solid #eee;
-  white-space: nowrap;          /* không xuống dòng */
-  overflow: hidden;
-}
-
-.list .item label {
-  display: flex;
-  align-items: center;
-  justify-content: space-between;
-  width: 100%;
-}
-
-.list .item .page-name{
-  flex: 1 1 auto;
-  min-width: 0;                /* allow text to shrink instead of pushing */
-  color: inherit;
-  text-align: left;
-  overflow: hidden;
-  text-overflow: ellipsis;
-  white-space: nowrap;
-}
-
-.list .item input[type="checkbox"]{
-  flex-shrink: 0 !important;
-  width: 18px !important;
-  height: 18px !important;
-  display: inline-block !important;
-  appearance: auto !important;
-  -webkit-appearance: checkbox !important;
-  transform: scale(1.2);
-  cursor: pointer;
-  margin-left: 12px;
-  margin-right: 4px;
-  align-self: center;
-}
-</style>
-</head>
-<body>
-  <div class="container">
-  <h1>Bản quyền AKUTA (2025)</h1>
-  <div class="tabs">
-    <button id="tab-posts" class="active">Đăng bài</button>
-    <button id="tab-inbox">Tin nhắn</button>
-        <button id="tab-page-info">Page info</button>
-  </div>
-
-  <div id="panel-posts" class="panel active">
-    <div class="row">
-      <div class="col">
-        <div class="card">
-          <h3>Fanpage</h3>
-          <div class="list" id="pages"></div>
-          <div class="status" id="pages_status" ></div>
-        </div>
-        <div class="card" style="margin-top:12px">
-          <h3>AI soạn nội dung</h3>
-          <textarea id="ai_prompt" rows="4" placeholder="Gợi ý chủ đề, ưu đãi, CTA..."></textarea>
-          <div class="grid">
-            <input id="ai_keyword" placeholder="Từ khoá chính (VD: MB66)"/>
-            <input id="ai_link" placeholder="Link chính thức (VD: https://...)"/>
-          </div>
-          <div class="grid">
-            <select id="ai_tone">
-              <option value="thân thiện">Giọng: Thân thiện</option>
-              <option value="chuyên nghiệp">Chuyên nghiệp</option>
-              <option value="hài hước">Hài hước</option>
-            </select>
-            <select id="ai_length">
-              <option value="ngắn">Ngắn</option>
-              <option value="vừa">Vừa</option>
-              <option value="dài">Dài</option>
-            </select>
-          </div>
-          <div class="toolbar" style="margin-top:8px">
-            <button class="btn" id="btn_ai">Tạo nội dung</button>
-            <span class="muted">Cần OPENAI_API_KEY</span>
-          </div>
-          <div class="status" id="ai_status"></div>
-        </div>
-      </div>
-      <div class="col">
-        <div class="card">
-          <h3>Đăng nội dung</h3>
-          <textarea id="post_text" rows="6" placeholder="Nội dung bài viết..."></textarea>
-          <div class="grid" style="margin-top:8px">
-            <div>
-              <label>Loại đăng</label>
-              <select id="post_type">
-                <option value="feed">Feed</option>
-                <option value="reels">Reels</option>
-              </select>
-            </div>
-            <div>
-              <label>Video</label>
-              <input type="file" id="video_input" accept="video/*"/>
-            </div>
-          </div>
-          <div class="grid" style="margin-top:8px">
-            <input type="file" id="photo_input" accept="image/*"/>
-            <input type="text" id="media_caption" placeholder="Caption (tuỳ chọn)"/>
-          </div>
-          <div class="toolbar" style="margin-top:8px">
-            <button class="btn primary" id="btn_publish">Đăng</button>
-          </div>
-          <div class="status" id="post_status"></div>
-        </div>
-      </div>
-    </div>
-  </div>
-
-  <div id="panel-inbox" class="panel">
-    <div class="row">
-      <div class="col">
-        <h3>Chọn Page</h3>
-        <select id="inbox_page"></select>
-        <button class="btn" id="btn_load_conv" style="margin-top:8px">Tải hội thoại</button>
-        <div class="list" id="conv_list" style="margin-top:8px"></div>
-      </div>
-      <div class="col">
-        <h3>Hội thoại</h3>
-        <div class="list" id="msg_list" style="min-height:280px"></div>
-        <div class="toolbar" style="margin-top:8px">
-          <input id="msg_text" placeholder="Nhập tin nhắn..."/>
-          <button class="btn primary" id="btn_send">Gửi</button>
-        </div>
-        <div class="status" id="inbox_status"></div>
-      </div>
-    </div>
-  </div>
-          <div class="grid" style="margin-top:8px">
-            <input id="cfg_short_token" placeholder="User short-lived token"/>
-          </div>
-          <div class="toolbar" style="margin-top:8px">
-            <button class="btn" id="btn_save_cfg">Lưu cấu hình</button>
-            <button class="btn primary" id="btn_exchange">Đổi token dài & lưu</button>
-          </div>
-          <div class="status" id="cfg_status"></div>
-        </div>
-      </div>
-      <div class="col">
-        <div class="card">
-          <h3>Diagnostics</h3>
-          <button class="btn" id="btn_diag">Chạy kiểm tra</button>
-          <pre id="diag_out" class="list" style="white-space:pre-wrap"></pre>
-        </div>
-      </div>
-    </div>
-  </div>
-
-  <div id="panel-page-info" class="panel">
-    <div class="row">
-      <div class="col">
-        <div class="card">
-          <h3>Chọn Page</h3>
-          <select id="info_page"></select>
-          <button class="btn" id="btn_load_info" style="margin-top:8px">Tải thông tin</button>
-        </div>
-        <div class="card" style="margin-top:12px">
-          <h3>Thông tin cơ bản</h3>
-          <div class="grid">
-            <input id="pg_name" placeholder="Tên Page"/>
-            <input id="pg_phone" placeholder="Số điện thoại"/>
-            <input id="pg_website" placeholder="Website"/>
-            <input id="pg_desc" placeholder="Mô tả (description)"/>
-          </div>
-          <div class="grid" style="margin-top:8px">
-            <input id="addr_street" placeholder="Địa chỉ (street)"/>
-            <input id="addr_city" placeholder="Thành phố"/>
-            <input id="addr_zip" placeholder="Mã bưu chính"/>
-            <input id="addr_country" placeholder="Quốc gia (VN, US...)"/>
-          </div>
-          <label style="display:flex;gap:6px;align-items:center;margin-top:8px">
-            <input type="checkbox" id="always_open"/> Luôn mở cửa
-          </label>
-          <div class="toolbar" style="margin-top:8px">
-            <button class="btn primary" id="btn_save_info">Lưu thay đổi</button>
-          </div>
-          <div class="status" id="info_status"></div>
-        </div>
-      </div>
-      <div class="col">
-        <div class="card">
-          <h3>Ảnh đại diện & Ảnh bìa</h3>
-          <div class="grid">
-            <div>
-              <label>Ảnh đại diện</label>
-              <input type="file" id="pic_avatar" accept="image/*"/>
-              <button class="btn" id="btn_set_avatar" style="margin-top:6px">Đổi avatar</button>
-            </div>
-            <div>
-              <label>Ảnh bìa</label>
-              <input type="file" id="pic_cover" accept="image/*"/>
-              <button class="btn" id="btn_set_cover" style="margin-top:6px">Đổi cover</button>
-            </div>
-          </div>
-          <div class="status" id="pic_status"></div>
-        </div>
-      </div>
-    </div>
-  </div>
-
-  <div class="pin-overlay" id="pin_overlay">
-    <div class="pin-box">
-      <h3>Nhập mã PIN để truy cập</h3>
-      <input id="pin_input" placeholder="Nhập PIN" type="password" style="margin-top:8px"/>
-      <div class="toolbar" style="margin-top:8px">
-        <button class="btn primary" id="btn_pin_ok">Xác nhận</button>
-      </div>
-      <div class="status" id="pin_status"></div>
-    </div>
-  </div>
-
-<script>
-const $ = sel => document.querySelector(sel);
-const sleep = (ms) => new Promise(res => setTimeout(res, ms));
-
-async function ensurePin(){
-  try{
-    const r = await fetch('/api/pin/status');
-    const d = await r.json();
-    if(d.need_pin && !d.ok){
-      $('#pin_overlay').style.display = 'flex';
-    }
-  }catch(e){}
-}
-$('#btn_pin_ok').onclick = async () => {
-  const pin = ($('#pin_input').value||'').trim();
-  const st = $('#pin_status');
-  if(!pin){ st.textContent='Nhập PIN trước'; return; }
-  const r = await fetch('/api/pin/login', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({pin})});
-  const d = await r.json();
-  if(d.ok){ $('#pin_overlay').style.display='none'; location.reload(); }
-  else{ st.textContent='PIN sai'; }
-};
-
-function showTab(name){
-  ['posts','inbox','settings','page-info'].forEach(n=>{
-    const id = n==='page-info' ? 'page-info' : n;
-    $('#tab-'+id).classList.toggle('active', id===name);
-    $('#panel-'+id).classList.toggle('active', id===name);
-  });
-}
-$('#tab-posts').onclick = ()=>showTab('posts');
-$('#tab-inbox').onclick = ()=>{ showTab('inbox'); loadPagesToSelect('inbox_page'); };
-$('#tab-page-info').onclick = ()=>{ showTab('page-info'); loadPagesToSelect('info_page'); };
-
-const pagesBox = $('#pages');
-const pagesStatus = $('#pages_status');
-
-async function loadPages(){
-  pagesBox.innerHTML = '<div class="muted">Đang tải...</div>';
-  try{
-    const r = await fetch('/api/pages');
-    const d = await r.json();
-    if(d.error){ pagesStatus.textContent = JSON.stringify(d); return; }
-        
-    const arr = d.data || [];
-// Sort pages by name (vi locale)
-    arr.sort((a,b)=> (a.name||'').localeCompare(b.name||'', 'vi', {sensitivity:'base'}));
-    pagesBox.innerHTML = arr.map(p => (
-      '<div class="item">'
-      + '<label>'
-      + '<span class="page-name">'+(p.name||'')+'</span>'
-      + '<input type="checkbox" class="pg" value="'+p.id+'" data-name="'+(p.name||'')+'">'
-      + '</label>'
-      + '</div>'
-    )).join('');
-    pagesStatus.textContent = 'Tải ' + arr.length + ' page.';
-  }catch(e){ pagesStatus.textContent = 'Lỗi tải danh sách page: ' + (e && (e.message||e.toString()) || ''); }
-}
-loadPages(); loadPagesToSelect('inbox_page'); ensurePin(); pollNewEvents();
-
-function selectedPageIds(){
-  return Array.from(document.querySelectorAll('.pg:checked')).map(i=>i.value);
-}
-
-async function loadPagesToSelect(selectId){
-  const sel = $('#'+selectId);
-  try{
-    const r = await fetch('/api/pages');
-    const d = await r.json();
-    if(d && d.error){
-      sel.innerHTML = '<option value="">(Lỗi: ' + String(d.error) + ')</option>';
-      const st = $('#inbox_status'); if(st){ st.textContent = 'Không tải được danh sách Page: ' + String(d.error); }
-      return;
-    }
-    const arr = (d && d.data) || [];
-    sel.innerHTML = '<option value="">--Chọn page--</option>' + arr.map(p=>'<option value="'+p.id+'">'+(p.name||p.id)+'</option>').join('');
-    const st = $('#inbox_status'); if(st){ st.textContent = 'Đã nạp ' + arr.length + ' page.'; }
-  }catch(e){
-    sel.innerHTML = '<option value="">(Không tải được)</option>';
-    const st = $('#inbox_status'); if(st){ st.textContent = 'Lỗi tải danh sách Page: ' + (e && (e.message||String(e)) || ''); }
-  }
-}
-
-// AI writer
-$('#btn_ai').onclick = async () => {
-  const prompt = ($('#ai_prompt').value||'').trim();
-  const tone = $('#ai_tone').value;
-  const length = $('#ai_length').value;
-  const keyword = ($('#ai_keyword').value||'MB66').trim();
-  const link = ($('#ai_link').value||'').trim();
-  const st = $('#ai_status');
-  if(!keyword){ st.textContent='Nhập từ khoá chính (VD: MB66)'; return; }
-  st.textContent = 'Đang tạo nội dung...';
-  try{
-    const r = await fetch('/api/ai/generate', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({prompt, tone, length, keyword, link})});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    $('#post_text').value = d.text || '';
-    st.textContent = 'Đã chèn nội dung vào khung soạn.';
-  }catch(e){ st.textContent = 'Lỗi gọi AI'; }
-};
-
-// Publish
-$('#btn_publish').onclick = async () => {
-  const pages = selectedPageIds();
-  const text = ($('#post_text').value||'').trim();
-  const type = $('#post_type').value;
-  const photo = $('#photo_input').files[0] || null;
-  const video = $('#video_input').files[0] || null;
-  const caption = ($('#media_caption').value||'');
-  const st = $('#post_status');
-
-  if(!pages.length){ st.textContent='Chọn ít nhất một page'; return; }
-  if(type === 'feed' && !text && !photo && !video){ st.textContent='Cần nội dung hoặc tệp'; return; }
-  if(type === 'reels' && !video){ st.textContent='Cần chọn video cho Reels'; return; }
-
-  st.textContent='Đang đăng (có giãn cách an toàn)...';
-  try{
-    const results = [];
-    for(const pid of pages){
-      let d;
-      if(type === 'feed'){
-        if(video){
-          const fd = new FormData();
-          fd.append('video', video);
-          fd.append('description', caption || text || '');
-          const r = await fetch('/api/pages/'+pid+'/video', {method:'POST', body: fd});
-          d = await r.json();
-        }else if(photo){
-          const fd = new FormData();
-          fd.append('photo', photo);
-          fd.append('caption', caption || text || '');
-          const r = await fetch('/api/pages/'+pid+'/photo', {method:'POST', body: fd});
-          d = await r.json();
-        }else{
-          const r = await fetch('/api/pages/'+pid+'/post', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({message: text})});
-          d = await r.json();
-        }
-      }else{
-        const fd = new FormData();
-        fd.append('video', video);
-        fd.append('description', caption || text || '');
-        const r = await fetch('/api/pages/'+pid+'/reel', {method:'POST', body: fd});
-        d = await r.json();
-      }
-      if(d.error){ results.push('❌ ' + pid + ': ' + JSON.stringify(d)); }
-      else{
-        const link = d.permalink_url ? ' · <a target="_blank" href="'+d.permalink_url+'">Mở bài</a>' : '';
-        results.push('✅ ' + pid + link);
-      }
-      await sleep(1500 + Math.floor(Math.random()*1500));
-    }
-    st.innerHTML = results.join('<br/>');
-  }catch(e){ st.textContent='Lỗi đăng'; }
-};
-
-// Settings: save + exchange
-$('#btn_save_cfg').onclick = async () => {
-  const app_id = $('#cfg_app_id').value.trim();
-  const app_secret = $('#cfg_app_secret').value.trim();
-  const st = $('#cfg_status');
-  if(!app_id || !app_secret){ st.textContent='Nhập App ID & Secret'; return; }
-  try{
-    const r = await fetch('/api/config', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({app_id, app_secret})});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã lưu cấu hình.';
-  }catch(e){ st.textContent='Lỗi lưu cấu hình'; }
-};
-
-$('#btn_exchange').onclick = async () => {
-  const app_id = $('#cfg_app_id').value.trim();
-  const app_secret = $('#cfg_app_secret').value.trim();
-  const short = $('#cfg_short_token').value.trim();
-  const st = $('#cfg_status');
-  if(!app_id || !app_secret || !short){ st.textContent='Nhập App ID, Secret & short token'; return; }
-  try{
-    await fetch('/api/config', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({app_id, app_secret})});
-    const r = await fetch('/api/token/exchange', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({short_token: short})});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã đổi token dài và lưu vào tokens.json';
-  }catch(e){ st.textContent='Lỗi đổi token'; }
-};
-
-// Page info: load existing (best-effort)
-$('#btn_load_info').onclick = async () => {
-  const pid = $('#info_page').value;
-  const st = $('#info_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  st.textContent='Đang tải...';
-  try{
-    const r = await fetch('/api/pages/'+pid+'/info');
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    $('#pg_name').value = d.name || '';
-    $('#pg_phone').value = d.phone || d.phone_number || '';
-    $('#pg_website').value = d.website || '';
-    $('#pg_desc').value = d.description || d.about || '';
-    const loc = d.location || {};
-    $('#addr_street').value = loc.street || '';
-    $('#addr_city').value = loc.city || '';
-    $('#addr_zip').value = loc.zip || '';
-    $('#addr_country').value = loc.country || '';
-    st.textContent='Đã tải xong.';
-  }catch(e){ st.textContent='Lỗi tải thông tin'; }
-};
-
-$('#btn_save_info').onclick = async () => {
-  const pid = $('#info_page').value;
-  const st = $('#info_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  const payload = {
-    name: ($('#pg_name').value||'').trim(),
-    phone: ($('#pg_phone').value||'').trim(),
-    website: ($('#pg_website').value||'').trim(),
-    description: ($('#pg_desc').value||'').trim(),
-    address: {
-      street: ($('#addr_street').value||'').trim(),
-      city: ($('#addr_city').value||'').trim(),
-      zip: ($('#addr_zip').value||'').trim(),
-      country: ($('#addr_country').value||'').trim()
-    }
-    
-    
-    ,
-    always_open: $('#always_open').checked
-  };
-  st.textContent='Đang lưu...';
-  try{
-    const r = await fetch('/api/pages/'+pid+'/info', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify(payload)});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã lưu xong.';
-  }catch(e){ st.textContent='Lỗi lưu thông tin'; }
-};
-
-$('#btn_set_avatar').onclick = async () => {
-  const pid = $('#info_page').value;
-  const file = $('#pic_avatar').files[0];
-  const st = $('#pic_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  if(!file){ st.textContent='Chưa chọn ảnh đại diện'; return; }
-  st.textContent='Đang cập nhật avatar...';
-  try{
-    const fd = new FormData();
-    fd.append('avatar', file);
-    const r = await fetch('/api/pages/'+pid+'/avatar', {method:'POST', body: fd});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã đổi avatar.';
-  }catch(e){ st.textContent='Lỗi đổi avatar'; }
-};
-
-$('#btn_set_cover').onclick = async () => {
-  const pid = $('#info_page').value;
-  const file = $('#pic_cover').files[0];
-  const st = $('#pic_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  if(!file){ st.textContent='Chưa chọn ảnh bìa'; return; }
-  st.textContent='Đang cập nhật cover...';
-  try{
-    const fd = new FormData();
-    fd.append('cover', file);
-    const r = await fetch('/api/pages/'+pid+'/cover', {method:'POST', body: fd});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã đổi cover.';
-  }catch(e){ st.textContent='Lỗi đổi cover'; }
-};
-
-// INBOX: load conversations and messages, send message
-let currentThread = null;
-let currentRecipient = null;
-
-$('#btn_load_conv').onclick = async () => {
-  const pid = $('#inbox_page').value;
-  const st = $('#inbox_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  st.textContent='Đang tải hội thoại...';
-  try{
-    const r = await fetch('/api/pages/'+pid+'/conversations');
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    const arr = d.data || [];
-    $('#conv_list').innerHTML = arr.map(cv => {
-      const unread = (cv.unread_count||0) > 0;
-      const dot = '<span class="dot '+(unread?'red':'green')+'"></span>';
-      let display = cv.id;
-      try{
-        const parts = (cv.participants && cv.participants.data) ? cv.participants.data : [];
-        const pageId = $('#inbox_page').value;
-        const other = parts.find(p => p.id !== pageId);
-        if(other && other.name) display = other.name;
-      }catch(_){}
-      return '<div class="conv-item">'+dot+'<a href="#" data-id="'+cv.id+'" class="open-thread conv-title">'+display+'</a><span class="muted"> — '+(cv.updated_time||'')+'</span></div>';
-    }).join('');
-    $('#conv_list').querySelectorAll('.open-thread').forEach(a => {
-      a.addEventListener('click', async (e) => {
-        e.preventDefault();
-        const tid = a.getAttribute('data-id');
-        await openThread(pid, tid);
-      });
-    });
-    st.textContent='Đã tải ' + arr.length + ' hội thoại.';
-  }catch(e){ st.textContent='Lỗi tải hội thoại'; }
-};
-
-async function openThread(pageId, threadId){
-  const st = $('#inbox_status');
-  st.textContent='Đang tải tin nhắn...';
-  try{
-    const r = await fetch('/api/pages/'+pageId+'/conversations/'+threadId);
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    const msgs = (d.messages && d.messages.data) ? d.messages.data : [];
-    currentThread = threadId;
-    // Xác định người nhận (không phải page) từ from/to của các message
-    let rec = null;
-    for(const m of msgs){
-      const tos = (m.to && m.to.data) ? m.to.data : [];
-      const fr = m.from || {};
-      for(const t of tos){
-        if(t.id !== pageId){ rec = t.id; break; }
-      }
-      if(!rec && fr.id !== pageId){ rec = fr.id; }
-      if(rec) break;
-    }
-    currentRecipient = rec;
-    const fmt = (iso) => { try{ return new Date(iso).toLocaleString(); }catch(_){ return iso||''; } };
-    const pageIdLocal = pageId || $('#inbox_page').value;
-    $('#msg_list').innerHTML = msgs.map(m => {
-      const fromId = (m.from && m.from.id) ? m.from.id : '';
-      const fromName = (m.from && (m.from.name||m.from.id)) ? (m.from.name||m.from.id) : 'Unknown';
-      const cls = (fromId === pageId) ? 'msg me' : 'msg other';
-      const text = (m.message || '[attachment]');
-      const time = fmt(m.created_time||'');
-      return '<div class="'+cls+'"><div class="bubble"><div><b>'+fromName+'</b></div><div>'+text+'</div><div class="meta">'+time+'</div></div></div>';
-    }).join('');
-    st.textContent='Đã tải ' + msgs.length + ' tin nhắn.' + (currentRecipient ? '' : ' (Không xác định được người nhận — cần nhắn từ thread trước)');
-  }catch(e){ st.textContent='Lỗi tải tin nhắn'; }
-}
-
-$('#btn_send').onclick = async () => {
-  const pid = $('#inbox_page').value;
-  const text = ($('#msg_text').value||'').trim();
-  const st = $('#inbox_status');
-  if(!pid){ st.textContent='Chưa chọn page'; return; }
-  if(!text){ st.textContent='Nhập nội dung trước'; return; }
-  if(!currentRecipient){ st.textContent='Chưa xác định người nhận từ hội thoại — hãy mở một thread trước.'; return; }
-  st.textContent='Đang gửi...';
-  try{
-    const r = await fetch('/api/pages/'+pid+'/messages', {method:'POST', headers:{'Content-Type':'application/json'}, body: JSON.stringify({recipient_id: currentRecipient, text})});
-    const d = await r.json();
-    if(d.error){ st.textContent='Lỗi: '+JSON.stringify(d); return; }
-    st.textContent='Đã gửi.';
-    if(currentThread){ await openThread(pid, currentThread); }
-    $('#msg_text').value='';
-  }catch(e){ st.textContent='Lỗi gửi tin nhắn'; }
-};
-async function pollNewEvents(){
-  const audio = document.getElementById('newMsg');
-  let lastTs = 0;
-  while(true){
-    try{
-      const r = await fetch('/webhook/events');
-      const d = await r.json();
-      const latest = d.length ? (d[d.length-1].ts||0) : 0;
-      // if there is a newer event and it looks like a message, play
-      if(latest && latest > lastTs){
-        lastTs = latest;
-        try{ await audio.play(); }catch(_){ /* require user interaction first */ }
-      }
-    }catch(e){}
-    await sleep(5000);
-  }
-} 
-</script>
-  </div>
-<audio id="newMsg" src="/static/new-message.mp3" preload="auto"></audio>
-
-<script id="HIDE_PHONE_FIELD_SNIPPET">
-(()=>{try{
-  const t=(el)=> (el.textContent||'').toLowerCase().includes('số điện thoại');
-  document.querySelectorAll('label,span,div').forEach(el=>{
-    if(t(el)){ el.style.display='none'; const n=el.nextElementSibling;
-      if(n && (n.tagName==='INPUT' || (n.name||'').toLowerCase().includes('phone'))) n.style.display='none';
-    }
-  });
-  document.querySelectorAll('input,textarea,select').forEach(inp=>{
-    const nm=(inp.name||'').toLowerCase(), id=(inp.id||'').toLowerCase(), ph=(inp.placeholder||'').toLowerCase();
-    if(nm.includes('phone')||id.includes('phone')||ph.includes('số điện thoại')) inp.style.display='none';
-  });
-}catch(_){}})();
-
-// --- Hide Settings & Page Info, keep only Posts and Inbox ---
-(function(){
-  function hideById(id){
-    const el = document.getElementById(id);
-    if(!el) return;
-    el.style.display = 'none';
-    const card = el.closest('.card');
-    if(card) card.style.display = 'none';
-    const panel = el.closest('.panel');
-    if(panel) panel.style.display = 'none';
-  }
-  // Hide tab button & panel
-  hideById('tab-page-info');
-  hideById('panel-page-info');
-
-  // Hide settings & diagnostics blocks
-  ['cfg_app_id','cfg_app_secret','cfg_short_token','btn_save_cfg','btn_exchange','cfg_status','btn_diag','diag_out']
-    .forEach(hideById);
-})();
-</script>
-</body>
-</html>"""
+app.config["SEND_FILE_MAX_AGE_DEFAULT"] = 3600
+# the page itself revalidates sooner than other static assets so UI updates propagate
+_INDEX_MAX_AGE = 300
+
+with open(os.path.join(app.static_folder, "index.html"), "rb") as _f:
+    _INDEX_BYTES = _f.read()
+_INDEX_GZ = gzip.compress(_INDEX_BYTES, 9)
+
+def _index_headers(body: bytes, encoding: Optional[str]) -> Dict[str, str]:
+    hdrs = {"ETag": '"%s"' % hashlib.blake2b(body, digest_size=16).hexdigest(),
+            "Cache-Control": f"public, max-age={_INDEX_MAX_AGE}",
+            "Vary": "Accept-Encoding"}
+    if encoding:
+        hdrs["Content-Encoding"] = encoding
+    return hdrs
+
+# body + fully built headers per encoding; the route only copies them in
+_INDEX_VARIANTS = {
+    "identity": (_INDEX_BYTES, _index_headers(_INDEX_BYTES, None)),
+    "gzip": (_INDEX_GZ, _index_headers(_INDEX_GZ, "gzip"))}
 
 @app.route("/")
 def index():
-    return render_template_string(INDEX_HTML)
+    body, hdrs = _INDEX_VARIANTS["gzip" if request.accept_encodings["gzip"] else "identity"]
+    resp = Response(body, mimetype="text/html", headers=hdrs)
+    return resp.make_conditional(request)
 
 # ----------------------------
 # APIs: pages & posting & reels (reusing patterns)
 # ----------------------------
-def reels_start(page_id: str, page_token: str):
-    return graph_post(f"{page_id}/video_reels", {"upload_phase": "start"}, page_token, ctx_key=_ctx_key_for_page(page_id))
+def reels_start(page_id: str, page_token: str, ctx_key: Optional[str] = None):
+    return graph_post(f"{page_id}/video_reels", {"upload_phase": "start"}, page_token, ctx_key=ctx_key or _ctx_key_for_page(page_id))
 
-def reels_finish(page_id: str, page_token: str, video_id: str, description: str):
-    return graph_post(f"{page_id}/video_reels", {"upload_phase": "finish", "video_id": video_id, "description": description}, page_token, ctx_key=_ctx_key_for_page(page_id))
+def reels_finish(page_id: str, page_token: str, video_id: str, description: str, ctx_key: Optional[str] = None):
+    return graph_post(f"{page_id}/video_reels", {"upload_phase": "finish", "video_id": video_id, "description": description}, page_token, ctx_key=ctx_key or _ctx_key_for_page(page_id))
+
+def _attach_permalink(data: Dict[str, Any], obj_id: Optional[str], page_token: str, ctx_key: str) -> Dict[str, Any]:
+    # best-effort follow-up after a publish: add permalink_url for the new object
+    # (skipped when the create call already returned it via read-after-write `fields`)
+    try:
+        if obj_id and not data.get("permalink_url"):
+            d2, s2 = graph_get(str(obj_id), {"fields": "permalink_url"}, page_token, ttl=0, ctx_key=ctx_key)
+            if s2 == 200 and isinstance(d2, dict) and d2.get("permalink_url"):
+                data["permalink_url"] = d2["permalink_url"]
+    except Exception: pass
+    return data
 
 @app.route("/api/pages")
 def api_list_pages():
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
+    token = _user_token()
     if token:
         data, status = graph_get("me/accounts", {"limit": 200}, token, ttl=0)
-        return jsonify(data), status
+        return json_response(data), status
 
     # Fallback: nếu có PAGE_TOKENS trong ENV thì trả về luôn danh sách page từ ENV
     try:
         env_pages = _env_pages_list()
         if env_pages:
-            return jsonify({"data": env_pages}), 200
+            return json_response({"data": env_pages}), 200
     except Exception:
         pass
 
-    return jsonify({"error": "NOT_LOGGED_IN"}), 401
+    return json_response({"error": "NOT_LOGGED_IN"}), 401
 
 @app.route("/api/pages/<page_id>/info")
 def api_page_info(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
     fields = "name,about,description,website,location{street,city,zip,country}"
     data, st = graph_get(page_id, {"fields": fields}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(data), st
+    return json_response(data), st
 
 # ------- Page info (POST update) -------
 @app.route("/api/pages/<page_id>/info", methods=["POST"])
 def api_page_update_info(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    body = request.get_json(force=True)
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
+    body = _json_body()
+    if body is None: return json_response({"error": "BAD_JSON"}), 400
 
     payload = {}
     # Simple fields
@@ -1154,222 +722,378 @@ def api_page_update_info(page_id):
             payload[f"hours[{day}_1_close]"] = "23:59"
 
     if not payload:
-        return jsonify({"error":"EMPTY_UPDATE"}), 400
+        return json_response({"error":"EMPTY_UPDATE"}), 400
 
     res, st = graph_post(page_id, payload, page_token, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(res), st
+    return json_response(res), st
 
 # ------- Avatar (profile picture) -------
 @app.route("/api/pages/<page_id>/avatar", methods=["POST"])
 def api_page_avatar(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
     if "avatar" not in request.files:
-        return jsonify({"error":"MISSING_FILE"}), 400
+        return json_response({"error":"MISSING_FILE"}), 400
     file = request.files["avatar"]
     files = {"source": (file.filename, file.stream, file.mimetype or "application/octet-stream")}
     data, st = graph_post_multipart(f"{page_id}/picture", files, {}, page_token, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(data), st
+    return json_response(data), st
 
 # ------- Cover: upload then set as cover -------
 @app.route("/api/pages/<page_id>/cover", methods=["POST"])
 def api_page_cover(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    if "cover" not in request.files: return jsonify({"error":"MISSING_FILE"}), 400
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
+    if "cover" not in request.files: return json_response({"error":"MISSING_FILE"}), 400
     file = request.files["cover"]
     files = {"source": (file.filename, file.stream, file.mimetype or "application/octet-stream")}
-    # 1) upload photo
-    up, st = graph_post_multipart(f"{page_id}/photos", files, {"published":"false"}, page_token, ctx_key=_ctx_key_for_page(page_id))
-    if st != 200 or not isinstance(up, dict) or not up.get("id"):
-        return jsonify({"error":"UPLOAD_FAILED", "detail": up}), st
-    photo_id = str(up.get("id"))
-    # 2) set as cover (best-effort, field name may vary)
-    setres, st2 = graph_post(page_id, {"cover": photo_id}, page_token, ctx_key=_ctx_key_for_page(page_id))
-    st3 = None
-    # Fallback: try cover_photo field if needed
+    ctx = _ctx_key_for_page(page_id)
+    # upload + set cover in one Graph batch; the second call reads the photo id from the first
+    batch = [
+        {"method": "POST", "relative_url": f"{page_id}/photos", "name": "up", "omit_response_on_success": False,
+         "attached_files": "source", "body": "published=false"},
+        {"method": "POST", "relative_url": page_id, "body": "cover={result=up:$.id}"},
+    ]
+    data, st = graph_post_multipart("", files, {"batch": _dumps(batch).decode(), "include_headers": "false"}, page_token, ctx_key=ctx)
+    if st != 200 or not isinstance(data, list) or len(data) < 2:
+        return json_response({"error":"UPLOAD_FAILED", "detail": data}), st if st != 200 else 502
+    up, st1 = _batch_item(data[0])
+    if st1 >= 400 or not isinstance(up, dict) or not up.get("id"):
+        return json_response({"error":"UPLOAD_FAILED", "detail": up}), st1 if st1 >= 400 else 502
+    setres, st2 = _batch_item(data[1])
+    # Fallback: try cover_photo field if needed (best-effort, field name may vary)
     if st2 >= 400:
-        setres2, st3 = graph_post(page_id, {"cover_photo": photo_id}, page_token, ctx_key=_ctx_key_for_page(page_id))
-        if st3 is not None and st3 < 400:
+        setres2, st3 = graph_post(page_id, {"cover_photo": str(up["id"])}, page_token, ctx_key=ctx)
+        if st3 < 400:
             setres, st2 = setres2, st3
-    return jsonify(setres), st2
+    return json_response(setres), st2
 
 # ------- Posting & Reels -------
 @app.route("/api/pages/<page_id>/post", methods=["POST"])
 def api_post_to_page(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error": "NOT_LOGGED_IN"}), 401
-    body = request.get_json(force=True)
+    token = _user_token()
+    if not token: return json_response({"error": "NOT_LOGGED_IN"}), 401
+    body = _json_body()
+    if body is None: return json_response({"error": "BAD_JSON"}), 400
     message = (body.get("message") or "").trim() if hasattr(str, "trim") else (body.get("message") or "").strip()
-    if not message: return jsonify({"error": "EMPTY_MESSAGE"}), 400
+    if not message: return json_response({"error": "EMPTY_MESSAGE"}), 400
     if _recent_content_guard("post", page_id, message, within_sec=3600):
-        return jsonify({"error": "DUPLICATE_MESSAGE", "note": "Nội dung tương tự đã được đăng gần đây (<=60 phút)."}), 429
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error": "NO_PAGE_TOKEN"}), 403
-    data, status = graph_post(f"{page_id}/feed", {"message": message}, page_token, ctx_key=_ctx_key_for_page(page_id))
-    try:
-        if status == 200 and isinstance(data, dict) and data.get("id"):
-            d2, s2 = graph_get(data["id"], {"fields": "permalink_url"}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-            if s2 == 200 and isinstance(d2, dict) and d2.get("permalink_url"):
-                data["permalink_url"] = d2["permalink_url"]
-    except Exception: pass
-    return jsonify(data), status
+        return json_response({"error": "DUPLICATE_MESSAGE", "note": "Nội dung tương tự đã được đăng gần đây (<=60 phút)."}), 429
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error": "NO_PAGE_TOKEN"}), 403
+    ctx = _ctx_key_for_page(page_id)
+    data, status = graph_post(f"{page_id}/feed", {"message": message, "fields": "id,permalink_url"}, page_token, ctx_key=ctx)
+    if status == 200 and isinstance(data, dict):
+        _attach_permalink(data, data.get("id"), page_token, ctx)
+    return json_response(data), status
+
+GRAPH_BATCH_MAX = 50
+
+@app.route("/api/pages/post_many", methods=["POST"])
+def api_post_many():
+    token = _user_token()
+    if not token: return json_response({"error": "NOT_LOGGED_IN"}), 401
+    body = _json_body()
+    if body is None: return json_response({"error": "BAD_JSON"}), 400
+    pids = list(dict.fromkeys(str(p) for p in (body.get("pids") or []) if p))
+    message = (body.get("message") or "").strip()
+    if not pids or not message: return json_response({"error": "MISSING_PAGES_OR_MESSAGE"}), 400
+    # duplicate guard / token lookup per page: a failing page is dropped, not the whole call;
+    # the hash is recorded up front (like /post) and forgotten for pages that did not publish
+    h = _hash_content(message)
+    results: Dict[str, Any] = {}
+    todo = []
+    for pid in pids:
+        if _recent_hash_guard("post", pid, h, within_sec=3600):
+            results[pid] = {"error": "DUPLICATE_MESSAGE", "note": "Nội dung tương tự đã được đăng gần đây (<=60 phút)."}
+            continue
+        page_token = _cached_page_token(pid, token)
+        if not page_token:
+            _recent_hash_forget("post", pid, h)
+            results[pid] = {"error": "NO_PAGE_TOKEN"}
+            continue
+        todo.append((pid, page_token))
+    # one Graph batch request per 50 pages, each sub-request with its own page token
+    for i in range(0, len(todo), GRAPH_BATCH_MAX):
+        chunk = todo[i:i + GRAPH_BATCH_MAX]
+        batch = [{"method": "POST", "relative_url": f"{pid}/feed",
+                  "body": urlencode({"message": message, "fields": "id,permalink_url", "access_token": pt})}
+                 for pid, pt in chunk]
+        data, st = graph_post("", {"batch": _dumps(batch).decode(), "include_headers": "false"}, token)
+        if st == 200 and isinstance(data, list):
+            for (pid, _), item in zip(chunk, data):
+                res, code = _batch_item(item)
+                results[pid] = res if code < 400 else {"error": "GRAPH_ERROR", "detail": res}
+        else:
+            for pid, _ in chunk: results[pid] = {"error": "BATCH_FAILED", "detail": data}
+        # a short batch response leaves trailing pages unanswered
+        for pid, _ in chunk:
+            res = results.setdefault(pid, {"error": "BATCH_FAILED"})
+            if isinstance(res, dict) and res.get("error") in ("BATCH_FAILED", "GRAPH_ERROR"):
+                _recent_hash_forget("post", pid, h)
+    return json_response({"results": results}), 200
 
 @app.route("/api/pages/<page_id>/photo", methods=["POST"])
 def api_post_photo(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    if "photo" not in request.files: return jsonify({"error":"MISSING_PHOTO"}), 400
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
+    if "photo" not in request.files: return json_response({"error":"MISSING_PHOTO"}), 400
     file = request.files["photo"]
     cap = request.form.get("caption","")
     if cap and _recent_content_guard("photo_caption", page_id, cap, within_sec=3600):
-        return jsonify({"error": "DUPLICATE_CAPTION", "note": "Caption ảnh đã được dùng gần đây (<=60 phút)."}), 429
+        return json_response({"error": "DUPLICATE_CAPTION", "note": "Caption ảnh đã được dùng gần đây (<=60 phút)."}), 429
     files = {"source": (file.filename, file.stream, file.mimetype or "application/octet-stream")}
     form = {"caption": cap, "published": "true"}
-    data, status = graph_post_multipart(f"{page_id}/photos", files, form, page_token, ctx_key=_ctx_key_for_page(page_id))
-    try:
-        if status == 200 and isinstance(data, dict):
-            pid = data.get("id") or data.get("post_id")
-            if pid:
-                d2, s2 = graph_get(str(pid), {"fields": "permalink_url"}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-                if s2 == 200 and isinstance(d2, dict) and d2.get("permalink_url"):
-                    data["permalink_url"] = d2["permalink_url"]
-    except Exception: pass
-    return jsonify(data), status
+    ctx = _ctx_key_for_page(page_id)
+    data, status = graph_post_multipart(f"{page_id}/photos", files, form, page_token, ctx_key=ctx)
+    if status == 200 and isinstance(data, dict):
+        _attach_permalink(data, data.get("id") or data.get("post_id"), page_token, ctx)
+    return json_response(data), status
 
 @app.route("/api/pages/<page_id>/video", methods=["POST"])
 def api_post_video(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    if "video" not in request.files: return jsonify({"error":"MISSING_VIDEO"}), 400
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
+    if "video" not in request.files: return json_response({"error":"MISSING_VIDEO"}), 400
     file = request.files["video"]
     desc = request.form.get("description","")
     if desc and _recent_content_guard("video_desc", page_id, desc, within_sec=3600):
-        return jsonify({"error": "DUPLICATE_DESCRIPTION", "note": "Mô tả video đã được dùng gần đây (<=60 phút)."}), 429
+        return json_response({"error": "DUPLICATE_DESCRIPTION", "note": "Mô tả video đã được dùng gần đây (<=60 phút)."}), 429
     files = {"source": (file.filename, file.stream, file.mimetype or "application/octet-stream")}
     form = {"description": desc}
-    data, status = graph_post_multipart(f"{page_id}/videos", files, form, page_token, ctx_key=_ctx_key_for_page(page_id))
-    try:
-        if status == 200 and isinstance(data, dict):
-            vid = data.get("id") or data.get("video_id")
-            if vid:
-                d2, s2 = graph_get(str(vid), {"fields": "permalink_url"}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-                if s2 == 200 and isinstance(d2, dict) and d2.get("permalink_url"):
-                    data["permalink_url"] = d2["permalink_url"]
-    except Exception: pass
-    return jsonify(data), status
+    ctx = _ctx_key_for_page(page_id)
+    data, status = graph_post_multipart(f"{page_id}/videos", files, form, page_token, ctx_key=ctx)
+    if status == 200 and isinstance(data, dict):
+        _attach_permalink(data, data.get("id") or data.get("video_id"), page_token, ctx)
+    return json_response(data), status
 
 @app.route("/api/pages/<page_id>/reel", methods=["POST"])
 def api_post_reel(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    if "video" not in request.files: return jsonify({"error":"MISSING_VIDEO"}), 400
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
+    if "video" not in request.files: return json_response({"error":"MISSING_VIDEO"}), 400
     file = request.files["video"]
     desc = request.form.get("description","")
-    start_res, st1 = reels_start(page_id, page_token)
+    ctx = _ctx_key_for_page(page_id)
+    start_res, st1 = reels_start(page_id, page_token, ctx_key=ctx)
     if st1 != 200 or not isinstance(start_res, dict) or "video_id" not in start_res:
-        return jsonify({"error":"REELS_START_FAILED", "detail": start_res}), st1
+        return json_response({"error":"REELS_START_FAILED", "detail": start_res}), st1
     video_id = start_res.get("video_id")
     headers = {"Authorization": f"OAuth {page_token}", "offset": "0", "Content-Type": "application/octet-stream"}
     try:
-        data_bytes = file.stream.read()
+        # stream the upload straight from the spooled file instead of reading it into RAM
+        stream = file.stream
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell()
+        stream.seek(0)
+        headers["file_size"] = headers["Content-Length"] = str(size)
         _wait_throttle("global")
-        ru = requests.post(f"{RUPLOAD_BASE}/{video_id}", headers=headers, data=data_bytes, timeout=600)
+        ru = SESSION.post(f"{RUPLOAD_BASE}/{video_id}", headers=headers, data=stream, timeout=(CONNECT_TIMEOUT, 600))
         if ru.status_code >= 400:
-            try: return jsonify({"error":"REELS_RUPLOAD_FAILED", "detail": ru.json()}), ru.status_code
-            except Exception: return jsonify({"error":"REELS_RUPLOAD_FAILED", "detail": ru.text}), ru.status_code
+            try: return json_response({"error":"REELS_RUPLOAD_FAILED", "detail": ru.json()}), ru.status_code
+            except Exception: return json_response({"error":"REELS_RUPLOAD_FAILED", "detail": ru.text}), ru.status_code
     except Exception as e:
-        return jsonify({"error":"REELS_RUPLOAD_EXCEPTION", "detail": str(e)}), 500
-    fin_res, st3 = reels_finish(page_id, page_token, video_id, desc)
-    if st3 != 200: return jsonify({"error":"REELS_FINISH_FAILED", "detail": fin_res}), st3
-    try:
-        vid = fin_res.get("video_id") or video_id
-        d2, s2 = graph_get(str(vid), {"fields": "permalink_url"}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-        if s2 == 200 and isinstance(d2, dict) and d2.get("permalink_url"):
-            fin_res["permalink_url"] = d2["permalink_url"]
-    except Exception: pass
-    return jsonify(fin_res), 200
+        return json_response({"error":"REELS_RUPLOAD_EXCEPTION", "detail": str(e)}), 500
+    fin_res, st3 = reels_finish(page_id, page_token, video_id, desc, ctx_key=ctx)
+    if st3 != 200: return json_response({"error":"REELS_FINISH_FAILED", "detail": fin_res}), st3
+    if isinstance(fin_res, dict):
+        _attach_permalink(fin_res, fin_res.get("video_id") or video_id, page_token, ctx)
+    return json_response(fin_res), 200
 
 # ----------------------------
 # INBOX APIs (new)
 # ----------------------------
+# Short-lived response caches; webhook events and sends evict the page's entries
+_CONV_LIST_CACHE: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+_THREAD_CACHE: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+CONV_LIST_TTL = 15
+THREAD_TTL = 60
+THREAD_CACHE_MAX = 64
+
+def _evict_inbox(page_id: Optional[str]):
+    # webhook payloads don't carry a thread id, so the whole page is dropped
+    if not page_id:
+        return
+    page_id = str(page_id)
+    _CONV_LIST_CACHE.pop(page_id, None)
+    for k in [k for k in _THREAD_CACHE if k[0] == page_id]:
+        _THREAD_CACHE.pop(k, None)
+
 @app.route("/api/pages/<page_id>/conversations")
 def api_list_conversations(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
+    cached = _ttl_cache_get(_CONV_LIST_CACHE, str(page_id))
+    if cached is not None: return json_response(cached), 200
     fields = "id,link,updated_time,unread_count,participants,senders"
     data, st = graph_get(f"{page_id}/conversations", {"fields": fields, "limit": 20}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(data), st
+    if st == 200 and isinstance(data, dict):
+        data["last_updated"] = int(pytime.time())
+        _ttl_cache_put(_CONV_LIST_CACHE, str(page_id), data, CONV_LIST_TTL, 256)
+    return json_response(data), st
 
 @app.route("/api/pages/<page_id>/conversations/<thread_id>")
 def api_get_conversation(page_id, thread_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
+    cache_key = (str(page_id), thread_id)
+    cached = _ttl_cache_get(_THREAD_CACHE, cache_key)
+    if cached is not None: return json_response(cached), 200
     fields = "id,link,messages.limit(50){id,created_time,from,to,message,attachments,shares,permalink_url},participants"
     data, st = graph_get(thread_id, {"fields": fields}, page_token, ttl=0, ctx_key=_ctx_key_for_page(page_id))
     # Map participant IDs to names to render on client nicely
-    try:
-        id2name = {}
-        for pcp in (data.get("participants", {}) or {}).get("data", []) if isinstance(data, dict) else []:
-            pid = pcp.get("id"); nm = pcp.get("name")
-            if pid and nm: id2name[str(pid)] = nm
-        msgs = (data.get("messages", {}) or {}).get("data", []) if isinstance(data, dict) else []
-        for m in msgs:
-            fr = m.get("from") or {}
-            if fr.get("id") and not fr.get("name"):
-                if str(fr["id"]) in id2name:
-                    fr["name"] = id2name[str(fr["id"])]
-                    m["from"] = fr
-    except Exception:
-        pass
-    return jsonify(data), st
+    if isinstance(data, dict):
+        # best-effort decoration: odd shapes in the Graph payload are passed through untouched
+        try:
+            parts = (data.get("participants") or {}).get("data") or []
+            id2name = {str(p["id"]): p["name"] for p in parts
+                       if isinstance(p, dict) and p.get("id") and p.get("name")}
+            if id2name:
+                for m in (data.get("messages") or {}).get("data") or []:
+                    fr = m.get("from") if isinstance(m, dict) else None
+                    if not isinstance(fr, dict):
+                        continue
+                    fid = fr.get("id")
+                    if fid and not fr.get("name") and (nm := id2name.get(str(fid))):
+                        fr["name"] = nm
+        except (AttributeError, TypeError, KeyError):
+            pass
+        if st == 200:
+            data["last_updated"] = int(pytime.time())
+            _ttl_cache_put(_THREAD_CACHE, cache_key, data, THREAD_TTL, THREAD_CACHE_MAX)
+    return json_response(data), st
 
 
 @app.route("/api/pages/<page_id>/messages", methods=["POST"])
 def api_send_message(page_id):
-    token = session.get("user_access_token") or (load_tokens().get("user_long") or {}).get("access_token")
-    if not token: return jsonify({"error":"NOT_LOGGED_IN"}), 401
-    page_token = get_page_access_token(page_id, token)
-    if not page_token: return jsonify({"error":"NO_PAGE_TOKEN"}), 403
-    body = request.get_json(force=True)
+    token = _user_token()
+    if not token: return json_response({"error":"NOT_LOGGED_IN"}), 401
+    page_token = _cached_page_token(page_id, token)
+    if not page_token: return json_response({"error":"NO_PAGE_TOKEN"}), 403
+    body = _json_body()
+    if body is None: return json_response({"error": "BAD_JSON"}), 400
     recipient_id = (body.get("recipient_id") or "").strip()
     text = (body.get("text") or "").strip()
     if not recipient_id or not text:
-        return jsonify({"error":"MISSING_RECIPIENT_OR_TEXT"}), 400
+        return json_response({"error":"MISSING_RECIPIENT_OR_TEXT"}), 400
     # For pages_messaging, recipient/message must be JSON strings in x-www-form-urlencoded
     data = {
-        "recipient": json.dumps({"id": recipient_id}),
-        "message": json.dumps({"text": text}),
+        "recipient": _dumps({"id": recipient_id}).decode(),
+        "message": _dumps({"text": text}).decode(),
         "messaging_type": "RESPONSE"
     }
     res, st = graph_post(f"{page_id}/messages", data, page_token, ctx_key=_ctx_key_for_page(page_id))
-    return jsonify(res), st
+    if st == 200: _evict_inbox(page_id)
+    return json_response(res), st
 
 # ----------------------------
 # AI writer & diagnostics/config/exchange
 # ----------------------------
+_AI_SYS_TMPL = (
+    "Bạn là copywriter mạng xã hội tiếng Việt. "
+    "Chỉ tạo NỘI DUNG THÂN BÀI và MỤC 'THÔNG TIN QUAN TRỌNG' (dưới dạng gạch đầu dòng). "
+    "Không viết tiêu đề, không thêm hashtag, không chèn thông tin liên hệ, không chèn link. "
+    "Giọng {tone}, độ dài {length}. Viết tự nhiên, tránh trùng lặp câu chữ giữa các gạch đầu dòng."
+)
+_AI_USER_TMPL = (
+    "Nhiệm vụ:\n"
+    "- Viết 1 đoạn thân bài (100-200 từ) mạch lạc, thuyết phục về chủ đề sau.\n"
+    "- Sau đó tạo 3-5 gạch đầu dòng cho mục 'Thông tin quan trọng', mỗi dòng 1 ý súc tích, độc đáo.\n"
+    "- KHÔNG thêm link, KHÔNG hashtag, KHÔNG thông tin liên hệ.\n"
+    "- Ngăn cách THÂN BÀI và GẠCH ĐẦU DÒNG bằng dòng đơn '---'.\n\n"
+    "Chủ đề: {prompt}\n"
+    "Từ khoá chính (chỉ tham chiếu trong thân bài khi cần): {keyword}\n"
+)
+_AI_DEFAULT_BULLETS = "- Truy cập an toàn, ổn định.\n- Hỗ trợ nhanh chóng khi cần.\n- Tối ưu trải nghiệm khi sử dụng."
+_AI_TAG_TMPL = ("#{k}", "#LinkChínhThức{n}", "#{n}AnToàn", "#HỗTrợLấyLạiTiền{n}", "#RútTiền{n}", "#MởKhóaTàiKhoản{n}")
+_AI_POST_TMPL = "{header}\n\n{body}\n\nThông tin quan trọng:\n\n{bullets}\n\nHashtags:\n{tags}"
+
+_OPENAI_URL = "https://api.openai.com/v1/chat/completions"
+
+# identical requests reuse the finished post instead of another multi-second completion;
+# a body with "fresh": true (the UI's regenerate) skips the lookup but still refreshes the entry
+_AI_CACHE: "OrderedDict[str, Tuple[float, str]]" = OrderedDict()
+_AI_CACHE_MAX = 512
+_AI_CACHE_TTL = 24 * 3600
+
+def _ai_cache_key(prompt: str, tone: str, length: str, keyword: str, link: str) -> str:
+    raw = f"{prompt}|{tone}|{length}|{keyword}|{link}|{OPENAI_MODEL}".encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def _ai_compose(raw: str, keyword: str, link: str) -> str:
+    body_text, bullets_text = raw, ""
+    if "\n---\n" in raw:
+        parts = raw.split("\n---\n", 1)
+        body_text = parts[0].strip()
+        bullets_text = parts[1].strip()
+    lines = [l.strip().lstrip("-• ").rstrip() for l in bullets_text.splitlines() if l.strip()]
+    bullets = "\n".join(["- " + l for l in lines]) if lines else _AI_DEFAULT_BULLETS
+    nospace = keyword.replace(" ", "")
+    tags = " ".join([t.format(k=keyword, n=nospace) for t in _AI_TAG_TMPL])
+    header = f"🌟 Truy Cập Link {keyword} Chính Thức - Không Bị Chặn 🌟\n#{keyword} ➡ {link or ''}".rstrip()
+    return _AI_POST_TMPL.format(header=header, body=body_text, bullets=bullets, tags=tags).strip()
+
+def _sse(obj, event: Optional[str] = None) -> bytes:
+    head = f"event: {event}\n".encode() if event else b""
+    return head + b"data: " + _dumps(obj) + b"\n\n"
+
+def _ai_stream(headers: Dict[str, str], payload: Dict[str, Any], keyword: str, link: str, cache_key: str):
+    """
+    Relay OpenAI deltas as SSE frames, then send the assembled post as a final 'done' event.
+    """
+    parts = []
+    try:
+        with SESSION.post(_OPENAI_URL, headers=headers, json={**payload, "stream": True},
+                          stream=True, timeout=(CONNECT_TIMEOUT, 60)) as r:
+            if r.status_code >= 400:
+                yield _sse({"error": "OPENAI_ERROR", "detail": r.text}, "error")
+                return
+            for line in r.iter_lines():
+                if not line.startswith(b"data: "):
+                    continue
+                frame = line[6:]
+                if frame == b"[DONE]":
+                    break
+                try:
+                    delta = (_loads(frame).get("choices") or [{}])[0].get("delta", {}).get("content") or ""
+                except Exception:
+                    continue
+                if delta:
+                    parts.append(delta)
+                    yield _sse({"delta": delta})
+    except Exception as e:
+        yield _sse({"error": "OPENAI_EXCEPTION", "detail": str(e)}, "error")
+        return
+    raw = "".join(parts).strip()
+    final_text = _ai_compose(raw, keyword, link)
+    if raw: _ttl_cache_put(_AI_CACHE, cache_key, final_text, _AI_CACHE_TTL, _AI_CACHE_MAX)
+    yield _sse({"text": final_text}, "done")
+
 @app.route("/api/ai/generate", methods=["POST"])
 def api_ai_generate():
     """
     Generate content with fixed structure and dynamic keyword/link.
+    With ?stream=1 the body is streamed as text/event-stream while OpenAI writes it.
+    Identical inputs are served from _AI_CACHE unless the body sets "fresh": true.
     """
     if not OPENAI_API_KEY:
-        return jsonify({"error":"NO_OPENAI_API_KEY"}), 400
-    body = request.get_json(force=True)
+        return json_response({"error":"NO_OPENAI_API_KEY"}), 400
+    body = _json_body()
+    if body is None: return json_response({"error": "BAD_JSON"}), 400
     prompt = (body.get("prompt") or "").strip()
     tone = (body.get("tone") or "thân thiện")
     length = (body.get("length") or "vừa")
@@ -1377,115 +1101,155 @@ def api_ai_generate():
     link = (body.get("link") or "").strip()
     if not prompt:
         prompt = f"Viết thân bài giới thiệu {keyword} ngắn gọn, khuyến khích truy cập link chính thức để đảm bảo an toàn và ổn định."
+    stream = request.args.get("stream") == "1"
+    cache_key = _ai_cache_key(prompt, tone, length, keyword, link)
+    cached = None if body.get("fresh") else _ttl_cache_get(_AI_CACHE, cache_key)
+    if cached is not None:
+        if stream:
+            return Response(_sse({"text": cached}, "done"), mimetype="text/event-stream",
+                            headers={"Cache-Control": "no-cache", "X-Cache": "HIT"})
+        resp = json_response({"text": cached})
+        resp.headers["X-Cache"] = "HIT"
+        return resp, 200
+    sys = _AI_SYS_TMPL.format(tone=tone, length=length)
+    user_prompt = _AI_USER_TMPL.format(prompt=prompt, keyword=keyword)
+    headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
+    payload = {"model": OPENAI_MODEL, "messages":[{"role":"system","content":sys},{"role":"user","content":user_prompt}], "temperature":0.8}
+    if stream:
+        return Response(stream_with_context(_ai_stream(headers, payload, keyword, link, cache_key)),
+                        mimetype="text/event-stream",
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
     try:
-        sys = (
-            "Bạn là copywriter mạng xã hội tiếng Việt. "
-            "Chỉ tạo NỘI DUNG THÂN BÀI và MỤC 'THÔNG TIN QUAN TRỌNG' (dưới dạng gạch đầu dòng). "
-            "Không viết tiêu đề, không thêm hashtag, không chèn thông tin liên hệ, không chèn link. "
-            f"Giọng {tone}, độ dài {length}. Viết tự nhiên, tránh trùng lặp câu chữ giữa các gạch đầu dòng."
-        )
-        user_prompt = (
-            "Nhiệm vụ:\n"
-            "- Viết 1 đoạn thân bài (100-200 từ) mạch lạc, thuyết phục về chủ đề sau.\n"
-            "- Sau đó tạo 3-5 gạch đầu dòng cho mục 'Thông tin quan trọng', mỗi dòng 1 ý súc tích, độc đáo.\n"
-            "- KHÔNG thêm link, KHÔNG hashtag, KHÔNG thông tin liên hệ.\n"
-            "- Ngăn cách THÂN BÀI và GẠCH ĐẦU DÒNG bằng dòng đơn '---'.\n\n"
-            f"Chủ đề: {prompt}\n"
-            f"Từ khoá chính (chỉ tham chiếu trong thân bài khi cần): {keyword}\n"
-        )
-        headers = {"Authorization": f"Bearer {OPENAI_API_KEY}", "Content-Type": "application/json"}
-        payload = {"model": OPENAI_MODEL, "messages":[{"role":"system","content":sys},{"role":"user","content":user_prompt}], "temperature":0.8}
-        r = requests.post("https://api.openai.com/v1/chat/completions", headers=headers, json=payload, timeout=60)
+        r = SESSION.post(_OPENAI_URL, headers=headers, json=payload, timeout=(CONNECT_TIMEOUT, 60))
         if r.status_code >= 400:
-            try: return jsonify({"error":"OPENAI_ERROR", "detail": r.json()}), r.status_code
-            except Exception: return jsonify({"error":"OPENAI_ERROR", "detail": r.text}), r.status_code
+            try: return json_response({"error":"OPENAI_ERROR", "detail": r.json()}), r.status_code
+            except Exception: return json_response({"error":"OPENAI_ERROR", "detail": r.text}), r.status_code
         data = r.json()
         raw = (data.get("choices") or [{}])[0].get("message", {}).get("content","").strip()
-        body_text, bullets_text = raw, ""
-        if "\n---\n" in raw:
-            parts = raw.split("\n---\n", 1)
-            body_text = parts[0].strip()
-            bullets_text = parts[1].strip()
-        lines = [l.strip().lstrip("-• ").rstrip() for l in bullets_text.splitlines() if l.strip()]
-        if lines:
-            bullets = "\n".join([f"- {l}" for l in lines])
-        else:
-            bullets = "- Truy cập an toàn, ổn định.\n- Hỗ trợ nhanh chóng khi cần.\n- Tối ưu trải nghiệm khi sử dụng."
-        key = keyword.strip()
-        nospace = key.replace(" ", "")
-        tags = [
-            f"#{key}",
-            f"#LinkChínhThức{nospace}",
-            f"#{nospace}AnToàn",
-            f"#HỗTrợLấyLạiTiền{nospace}",
-            f"#RútTiền{nospace}",
-            f"#MởKhóaTàiKhoản{nospace}",
-        ]
-        header = f"🌟 Truy Cập Link {key} Chính Thức - Không Bị Chặn 🌟\n#{key} ➡ {link or ''}".rstrip()
-        final_text = (
-f"""{header}
-
-{body_text}
-
-Thông tin quan trọng:
-
-{bullets}
-
-Hashtags:
-{' '.join(tags)}"""
-        ).strip()
-        return jsonify({"text": final_text}), 200
+        final_text = _ai_compose(raw, keyword, link)
+        if raw: _ttl_cache_put(_AI_CACHE, cache_key, final_text, _AI_CACHE_TTL, _AI_CACHE_MAX)
+        return json_response({"text": final_text}), 200
     except Exception as e:
-        return jsonify({"error":"OPENAI_EXCEPTION", "detail": str(e)}), 500
+        return json_response({"error":"OPENAI_EXCEPTION", "detail": str(e)}), 500
 
 # ----------------------------
 # Diagnostics/config/token
 # ----------------------------
+def _verify_signature(raw: bytes) -> bool:
+    # X-Hub-Signature-256: "sha256=" + hex HMAC-SHA256 of the raw body under the app secret
+    sig = request.headers.get("X-Hub-Signature-256", "")
+    if not sig.startswith("sha256="):
+        return False
+    expected = hmac.new(_APP_SECRET_BYTES, raw, hashlib.sha256).hexdigest()
+    return hmac.compare_digest(expected, sig[7:])
+
+def _hub_params(qs: bytes) -> Tuple[Optional[bytes], Optional[bytes]]:
+    # (hub.verify_token, hub.challenge) straight from the query bytes, still url-encoded
+    verify = challenge = None
+    for part in qs.split(b"&"):
+        k, _, v = part.partition(b"=")
+        if k == b"hub.verify_token": verify = v
+        elif k == b"hub.challenge": challenge = v
+    return verify, challenge
+
+def _extract_message(m: Dict[str, Any]) -> Tuple[Any, Any, Any]:
+    # (sender, text, timestamp) of one webhook message, without sentinel dicts;
+    # payloads come from _loads, so nested objects are exact dicts (class check, no isinstance call)
+    t = m.get("text")
+    text = (t.get("body") if t.__class__ is dict else None) or m.get("message")
+    sender = m.get("from")
+    if sender is None:
+        snd = m.get("sender")
+        sender = snd.get("id") if snd.__class__ is dict else None
+    return sender, text, m.get("timestamp")
+
 @app.route("/webhook", methods=["GET", "POST"])
 def webhook():
     if request.method == "GET":
+        # fast path on the raw query bytes; anything escaped goes through request.args below
+        qv, qc = _hub_params(request.query_string)
+        if qv is not None and _VERIFY_TOKEN_QS and hmac.compare_digest(qv, _VERIFY_TOKEN_QS) \
+                and not (qc and (b"%" in qc or b"+" in qc)):
+            return qc or b"", 200
         verify = request.args.get("hub.verify_token")
         challenge = request.args.get("hub.challenge")
-        if verify == SETTINGS.get("webhook_verify_token"):
+        if verify and _VERIFY_TOKEN_BYTES and hmac.compare_digest(verify.encode("utf-8"), _VERIFY_TOKEN_BYTES):
             return challenge or "", 200
         return "Forbidden", 403
+    raw = request.get_data(cache=False)
+    if _APP_SECRET_BYTES and not _verify_signature(raw):
+        return "Invalid signature", 403
     try:
-        data = request.get_json(force=True)
+        data = _loads(raw) if raw else {}
     except Exception:
-        data = {"error": "invalid json"}
-    SETTINGS["_last_events"].append({"ts": int(pytime.time()), "data": data})
-    SETTINGS["_last_events"] = SETTINGS["_last_events"][-100:]
-    
+        raw, data = b"", {"error": "invalid json"}
+    # one clock read per delivery: every event in it shares the arrival time
+    now_ts = int(pytime.time())
+    events = []
     try:
         entries = (data or {}).get("entry", [])
         for en in entries:
+            # Messenger deliveries are entry[].messaging[] with no "changes": evict by the entry's page
+            _evict_inbox(en.get("id"))
             for chg in en.get("changes", []):
                 val = chg.get("value", {})
+                val_page = val.get("page") or val.get("page_id")
+                if val_page: _evict_inbox(val_page)
                 # message events
-                for m in val.get("messages", []) or []:
-                    sender = (m.get("from") or (m.get("sender") or {}).get("id"))
-                    text = (m.get("text", {}) or {}).get("body") or m.get("message")
-                    broadcast({"type":"message", "page_id": val.get("page") or val.get("page_id"), "sender_id": sender, "text": text, "time": m.get("timestamp")})
-                for mr in val.get("message_reads", []) or []:
-                    broadcast({"type":"message_reads", "page_id": val.get("page") or val.get("page_id"), "watermark": val.get("watermark")})
+                for m in val.get("messages") or ():
+                    sender, text, ts = _extract_message(m)
+                    events.append({"type":"message", "page_id": val_page, "sender_id": sender, "text": text, "time": ts or now_ts})
+                for mr in val.get("message_reads") or ():
+                    events.append({"type":"message_reads", "page_id": val_page, "watermark": val.get("watermark")})
     except Exception:
         pass
+    # one envelope per delivery instead of one per message; pollers of /webhook/events unpack it
+    # the audit trail keeps the delivery's own bytes, so /webhook/events polls don't re-encode the tree;
+    # truncated bytes would not be valid JSON, so an oversized body is kept as a size marker instead
+    if len(raw) > WEBHOOK_AUDIT_MAX:
+        audit = {"error": "too large", "size": len(raw)}
+    else:
+        audit = _Fragment(raw) if _Fragment and raw else data
+    rec = {"ts": now_ts, "data": audit}
+    if events: rec["batch"] = {"type": "webhook_batch", "events": events}
+    SETTINGS["_last_events"].append(rec)
+    _EVENT_SEQ[0] += 1
     return "ok", 200
+
+def _etag_headers(etag: str) -> Dict[str, str]:
+    return {"ETag": etag, "Cache-Control": "no-cache"}
+
 @app.route("/webhook/events")
 def webhook_events():
-    return jsonify(SETTINGS.get("_last_events", [])[-20:]), 200
+    etag = f'W/"{_EVENT_SEQ[0]}"'
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers=_etag_headers(etag))
+    ev = SETTINGS["_last_events"]
+    resp = json_response(list(islice(ev, max(0, len(ev) - 20), None)), passthrough=True)
+    resp.headers.update(_etag_headers(etag))
+    return resp, 200
 
 @app.route("/api/usage")
 def api_usage():
     now = int(pytime.time())
-    return jsonify({
-        "cooldown_remaining": max(0, int(SETTINGS.get("cooldown_until",0) or 0) - now),
-        "last_usage": SETTINGS.get("last_usage", {}),
-        "poll_intervals": SETTINGS.get("poll_intervals")
-    }), 200
+    cu = _COOLDOWN_UNTIL[0]
+    remaining = cu - now if cu > now else 0
+    # the remaining cooldown is in the tag too: it ticks down while a cooldown is active
+    etag = f'W/"{_USAGE_REV[0]}-{remaining}"'
+    if request.headers.get("If-None-Match") == etag:
+        return Response(status=304, headers=_etag_headers(etag))
+    resp = json_response({
+        "cooldown_remaining": remaining,
+        "last_usage": _LAST_USAGE,
+        "poll_intervals": _POLL_INTERVALS
+    }, passthrough=True)
+    resp.headers.update(_etag_headers(etag))
+    return resp, 200
 
 if __name__ == "__main__":
+    from gevent.pywsgi import WSGIServer
     port = int(os.environ.get("PORT", "5000"))
-    app.run(host="0.0.0.0", port=port, debug=True, use_reloader=False)
+    # same concurrency cap as the Procfile's --worker-connections
+    WSGIServer(("0.0.0.0", port), app, spawn=200).serve_forever()
 
 # WARNING: Patch did not apply automatically.